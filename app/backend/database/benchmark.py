@@ -0,0 +1,152 @@
+"""Compare storage backends, model serialization and script interpreters
+
+Run: python -m app.backend.database.benchmark [rows]
+"""
+from app.backend.database.database import DatabaseService, make_storage_backend
+from app.backend.database.models import Block, Transaction, TXInput, TXOutput, UTXO
+from app.backend.database.script import ScriptService, Operation
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey, Ed25519PublicKey
+from hashlib import sha256
+import pickle
+import tempfile
+import time
+import sys
+import os
+
+
+def _timeit(name: str, func, count: int):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print(f'\t{name:<16} {elapsed:8.3f}s {count / elapsed:12.0f} op/s')
+
+
+def _make_utxos(count: int) -> list[UTXO]:
+    utxos_list = []
+    for i in range(count):
+        tx = Transaction(
+            inputs=[],
+            outputs=[TXOutput(input_index=0, lock_script=sha256(str(i).encode()).digest(), value=f'{i};{i}'.encode())]
+        )
+        utxos_list.append(UTXO.from_transaction(tx, 0))
+    return utxos_list
+
+
+def benchmark_backend(backend: str, rows: int):
+    print(backend)
+    utxos_list = _make_utxos(rows)
+    with tempfile.TemporaryDirectory() as dirname:
+        filename = os.path.join(dirname, 'db')
+        db_service = DatabaseService(make_storage_backend(backend, filename))
+
+        def save():
+            for utxos in utxos_list[:rows // 2]:
+                db_service.save(utxos)
+
+        def save_batch():
+            with db_service.batch():
+                for utxos in utxos_list[rows // 2:]:
+                    db_service.save(utxos)
+
+        def find():
+            for utxos in utxos_list:
+                db_service.find('utxo', tx_id=utxos.tx_id)
+
+        def get():
+            for utxos in utxos_list:
+                db_service.get('utxo', utxos.id)
+
+        def load():
+            make_storage_backend(backend, filename).close()
+
+        def delete():
+            with db_service.batch():
+                for utxos in utxos_list:
+                    db_service.delete('utxo', utxos.id)
+
+        _timeit('save', save, rows // 2)
+        _timeit('save batch', save_batch, rows - rows // 2)
+        _timeit('find indexed', find, rows)
+        _timeit('get', get, rows)
+        _timeit('load', load, 1)
+        _timeit('delete batch', delete, rows)
+        db_service.backend.close()
+
+
+def benchmark_serialization(rows: int):
+    print('serialization')
+    transactions = [
+        Transaction(
+            inputs=[TXInput(tx_id=sha256(str(i).encode()).hexdigest(), output_index=0, unlock_script=bytes(64))],
+            outputs=[TXOutput(input_index=0, lock_script=sha256(str(i).encode()).digest(), value=f'{i};{i}'.encode())]
+        )
+        for i in range(100)
+    ]
+    block = Block(transactions=transactions, previous_hash=sha256(b'prev').hexdigest(), nounce=1)
+    pickled, dumped = pickle.dumps(block), block.dump()
+    print(f'\tblock size       pickle {len(pickled)} bytes, binary {len(dumped)} bytes')
+    _timeit('pickle dump', lambda: [pickle.dumps(block) for _ in range(rows)], rows)
+    _timeit('binary dump', lambda: [block.dump() for _ in range(rows)], rows)
+    _timeit('pickle load', lambda: [pickle.loads(pickled) for _ in range(rows)], rows)
+    _timeit('binary load', lambda: [Block.undump(dumped) for _ in range(rows)], rows)
+
+
+def _push(data: bytes) -> bytes:
+    return Operation.push.value + len(data).to_bytes(8) + data
+
+
+def benchmark_scripts(rows: int):
+    """Interpreter decoding every run against compiled cached program and native run of standard scripts"""
+    print('scripts')
+    key = Ed25519PrivateKey.generate()
+    public_key = key.public_key().public_bytes_raw()
+    message = sha256(b'spent transaction').digest()
+    signature = key.sign(message)
+    address_check = (
+        _push(signature) + _push(public_key),
+        ScriptService.make_address_lock_script(sha256(public_key).digest()),
+        message,
+        []
+    )
+    position_check = (
+        b'',
+        _push(b'10;20') + Operation.push_alt.value + Operation.check_equal.value,
+        message,
+        [b'10;20']
+    )
+    for name, (unlock_script, lock_script, message, altstack) in (
+            ('pay-to-address', address_check),
+            ('position', position_check)
+    ):
+        def interpreted():
+            for _ in range(rows):
+                ScriptService(unlock_script, message, list(altstack), lock_script).run_interpreted()
+
+        def compiled():
+            for _ in range(rows):
+                ScriptService(unlock_script, message, list(altstack), lock_script).run_compiled()
+
+        def native():
+            for _ in range(rows):
+                ScriptService(unlock_script, message, list(altstack), lock_script).run()
+
+        print(f'\t{name}')
+        _timeit('interpreted', interpreted, rows)
+        _timeit('compiled', compiled, rows)
+        _timeit('native', native, rows)
+
+    def verify_only():
+        public = Ed25519PublicKey.from_public_bytes(public_key)
+        for _ in range(rows):
+            public.verify(signature, address_check[2])
+
+    print('\tsignature')
+    _timeit('verify only', verify_only, rows)
+
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    benchmark_scripts(rows)
+    benchmark_serialization(rows)
+    for backend in ('log', 'sqlite'):
+        benchmark_backend(backend, rows)
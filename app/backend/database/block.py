@@ -1,18 +1,50 @@
 from app.backend.utils import asdict
 from app.backend.database.models import Tip, Block, Transaction, StorableModel
+from app.backend.database.models import TransactionLocation, BlockIndex, BlockUndo, BlockHeight
+from app.backend.database.blocktree import BlockTree
+from collections import OrderedDict
+from dataclasses import replace
 import datetime as dt
+import threading
+import os
+
+BLOCKS_CACHE_SIZE = int(os.getenv('BLOCKS_CACHE_SIZE', '256'))
 
 
 class BlockService:
-    def __init__(self, db_service):
+    """Blocks bodies and their undo records are kept in block files, only block index is loaded in database
+
+    Blocks of side branches are stored too, tree of all stored blocks is kept in memory.
+    """
+
+    def __init__(self, db_service, block_file_service, miner_service):
         self.db_service = db_service
+        self.block_file_service = block_file_service
+        self.miner_service = miner_service
 
-    def mine(self, block: Block):
-        while not block.hash.startswith('00'):
-            block.nounce += 1
-        return block
+        self._cache: OrderedDict[str, Block] = OrderedDict()  # LRU of decoded blocks
+        self._cache_lock = threading.Lock()
+        self.tree = BlockTree()
+        self._load_tree()
+        self.db_service.on_rollback(self._rollback)
 
-    def make(self, transactions: list[Transaction], prev_hash, timestamp, nounce) -> Block:
+    def _rollback(self):
+        """Blocks written and tree nodes added in rolled back batch must not be used"""
+        with self._cache_lock:
+            self._cache.clear()
+        self.tree.clear()
+        self._load_tree()
+
+    def _load_tree(self):
+        indexes = self.db_service.find(BlockIndex.table_name)
+        for index in sorted(indexes, key=lambda index: index.height):
+            self.tree.add(index.id, index.previous_hash)
+
+    def mine(self, block: Block) -> Block | None:
+        """Return None if mining was cancelled by stored block with the same parent"""
+        return self.miner_service.mine(block)
+
+    def make(self, transactions: list[Transaction], prev_hash, timestamp, nounce) -> Block | None:
         if prev_hash is None:
             last_block = self.get_last()
             prev_hash = '' if last_block is None else last_block.hash
@@ -34,16 +66,141 @@ class BlockService:
             return True
         return tip_block.hash == block.previous_hash
 
-    def store(self, block: Block) -> int | None:
+    def store(self, block: Block, undo: BlockUndo = None) -> int | None:
+        """Connect block to tip of chain
+
+        undo: changes of utxos made by block, written to block files after it
+        Block stored before on side branch is not written again.
+        """
         if not self.validate_block(block):
             return
-        self.db_service.save(Tip(value=block.hash))
-        return self.db_service.save(block)
+        with self.db_service.batch():
+            height = self.get_tip_height() + 1
+            self.db_service.save(Tip(value=block.hash))
+            self.db_service.save(BlockHeight(id=height, hash=block.hash))
+            for position, tx in enumerate(block.transactions):
+                self.db_service.save(TransactionLocation(id=tx.id, block_hash=block.hash, position=position))
+            index = self.db_service.get(BlockIndex.table_name, block.hash)
+            if index is None:
+                index = self._write_body(block, height)
+            if undo is not None:
+                undo_segment, undo_offset, undo_size = self.block_file_service.write(undo)
+                index = replace(index, undo_segment=undo_segment, undo_offset=undo_offset, undo_size=undo_size)
+            block_id = self.db_service.save(index)
+        self.tree.add(block.hash, block.previous_hash)
+        self.miner_service.cancel(block.previous_hash)  # Mined block would compete with stored one
+        return block_id
+
+    def store_side(self, block: Block) -> str | None:
+        """Store block of side branch, chain is not changed. Return None if parent is unknown"""
+        node = self.tree.add(block.hash, block.previous_hash)
+        if node is None:
+            return
+        if self.db_service.get(BlockIndex.table_name, block.hash) is not None:
+            return block.hash
+        return self.db_service.save(self._write_body(block, node.height))
+
+    def _write_body(self, block: Block, height: int) -> BlockIndex:
+        """Return index of written block, it is not saved"""
+        segment, offset, size = self.block_file_service.write(block)
+        self._cache_block(block)
+        return BlockIndex(
+            id=block.hash,
+            previous_hash=block.previous_hash,
+            segment=segment,
+            offset=offset,
+            size=size,
+            height=height
+        )
+
+    def disconnect_tip(self) -> Block | None:
+        """Remove last block from chain and return it, block is kept on side branch"""
+        block = self.get_last()
+        if block is None:
+            return
+        with self.db_service.batch():
+            for tx in block.transactions:
+                location = self.get_transaction_location(tx.id)
+                if location is not None and location.block_hash == block.hash:
+                    self.db_service.delete(TransactionLocation.table_name, tx.id)
+            index = self.db_service.get(BlockIndex.table_name, block.hash)
+            self.db_service.delete(BlockHeight.table_name, index.height)
+            self.db_service.save(replace(index, undo_segment=0, undo_offset=0, undo_size=0))  # Record is left in file
+            self.db_service.save(Tip(value=block.previous_hash))
+        self.miner_service.cancel(block.hash)
+        return block
+
+    def get_undo(self, block_hash: str) -> BlockUndo | None:
+        """Undo record of block connected to chain"""
+        index = self.db_service.get(BlockIndex.table_name, block_hash)
+        if index is not None and index.undo_size:
+            return self.block_file_service.read(index.undo_segment, index.undo_offset, index.undo_size, BlockUndo)
 
     def get_last(self) -> Block | None:
-        last_hash = self.db_service.get(Tip.table_name, 'tip')
+        last_hash = self.get_tip_hash()
         if last_hash:
-            return self.get_one(last_hash.value)
+            return self.get_one(last_hash)
+
+    def get_tip_hash(self) -> str | None:
+        tip = self.db_service.get(Tip.table_name, 'tip')
+        if tip is not None:
+            return tip.value
+
+    def get_height(self, block_hash: str) -> int | None:
+        index = self.db_service.get(BlockIndex.table_name, block_hash)
+        if index is not None:
+            return index.height
+
+    def get_tip_height(self) -> int:
+        """Return -1 if chain is empty"""
+        tip = self.db_service.get(Tip.table_name, 'tip')
+        if tip is None:
+            return -1
+        height = self.get_height(tip.value)
+        return -1 if height is None else height
+
+    def get_by_height(self, height: int) -> Block | None:
+        block_height = self.db_service.get(BlockHeight.table_name, height)
+        if block_height is not None:
+            return self.get_one(block_height.hash)
+
+    def get_locator(self) -> dict[str, int]:
+        """Hashes of chain with their heights, from tip to genesis
+
+        Last ten blocks are included, then step between heights doubles.
+        Locator always ends with '' - previous hash of genesis, at height -1.
+        """
+        locator = {}
+        tip_height = self.get_tip_height()
+        height, step = tip_height, 1
+        while height > 0:
+            locator[self.db_service.get(BlockHeight.table_name, height).hash] = height
+            if len(locator) >= 10:
+                step *= 2
+            height -= step
+        if tip_height >= 0:
+            locator[self.db_service.get(BlockHeight.table_name, 0).hash] = 0
+        locator[''] = -1
+        return locator
+
+    def find_fork(self, locator: list[str]) -> int:
+        """Height of first locator hash in chain, -1 if there is none"""
+        for block_hash in locator:
+            height = self.get_height(block_hash)
+            if height is None:
+                continue
+            block_height = self.db_service.get(BlockHeight.table_name, height)
+            if block_height is not None and block_height.hash == block_hash:
+                return height
+        return -1
+
+    def iterate_heights(self, start: int, stop: int) -> Block:
+        """Blocks of chain from start height to stop height, not including stop"""
+        for height in range(max(start, 0), min(stop, self.get_tip_height() + 1)):
+            block = self.get_by_height(height)
+            if block is None:
+                return
+            yield block
 
     def iterate_blocks(self, stop_hash: str | None = None) -> Block:
         curr_block = self.get_last()
@@ -54,17 +211,38 @@ class BlockService:
             yield curr_block
             curr_block = self.get_one(curr_block.previous_hash)
 
-    def get_one(self, block_hash) -> Block | None:
-        return self.db_service.get(Block.table_name, block_hash)
+    def _cache_block(self, block: Block):
+        with self._cache_lock:
+            self._cache[block.hash] = block
+            self._cache.move_to_end(block.hash)
+            while len(self._cache) > BLOCKS_CACHE_SIZE:
+                self._cache.popitem(last=False)
 
-    def get_many(self, **filters) -> list[Block]:
-        res = self.db_service.find(Block.table_name, **filters)
-        return res
+    def get_one(self, block_hash) -> Block | None:
+        with self._cache_lock:
+            block = self._cache.get(block_hash)
+            if block is not None:
+                self._cache.move_to_end(block_hash)
+                return block
+        index = self.db_service.get(BlockIndex.table_name, block_hash)
+        if index is None:
+            return
+        block = self.block_file_service.read(index.segment, index.offset, index.size)
+        self._cache_block(block)
+        return block
 
-    def append_chain(self, new_chain: list[Block]):
-        for block in self.get_many():
-            self.db_service.delete(Block.table_name, block.hash)
+    def get_transaction_location(self, tx_id: str) -> TransactionLocation | None:
+        return self.db_service.get(TransactionLocation.table_name, tx_id)
 
-        [self.store(block) for block in new_chain[::-1]]
-        print('chain', *new_chain, sep='\n')
+    def get_transaction(self, tx_id: str) -> Transaction | None:
+        location = self.get_transaction_location(tx_id)
+        if location is None:
+            return
+        block = self.get_one(location.block_hash)
+        if block is None:
+            return
+        return block.transactions[location.position]
 
+    def get_many(self, **filters) -> list[Block]:
+        """Filters are applied to block index"""
+        return [self.get_one(index.id) for index in self.db_service.find(BlockIndex.table_name, **filters)]
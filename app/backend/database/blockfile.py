@@ -0,0 +1,57 @@
+from app.backend.database.database import DB_FILENAME
+from app.backend.database.models import Block, StorableModel
+import threading
+import mmap
+import os
+
+BLOCKS_DIRNAME = os.getenv('BLOCKS_DIRNAME', DB_FILENAME + '_blocks')
+BLOCKS_SEGMENT_SIZE = int(os.getenv('BLOCKS_SEGMENT_SIZE', str(16 * 1024 * 1024)))
+
+
+class BlockFileService:
+    """Append-only segment files with encoded blocks and their undo records
+
+    Record is addressed by (segment, offset, size), which is kept in block index.
+    Segments are read through mmap, so only accessed records are decoded.
+    """
+
+    def __init__(self, dirname: str = BLOCKS_DIRNAME):
+        self.dirname = dirname
+        os.makedirs(self.dirname, exist_ok=True)
+        segments = [int(name.split('.')[0]) for name in os.listdir(self.dirname) if name.endswith('.dat')]
+        self._segment = max(segments, default=0)
+        self._file = open(self._segment_path(self._segment), 'ab')
+        self._maps: dict[int, mmap.mmap] = {}
+        self._lock = threading.Lock()
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.dirname, f'{segment:05}.dat')
+
+    def write(self, record: StorableModel) -> tuple[int, int, int]:
+        """Return (segment, offset, size) of written record"""
+        data = record.dump()
+        with self._lock:
+            if self._file.tell() and self._file.tell() + len(data) > BLOCKS_SEGMENT_SIZE:
+                self._file.close()
+                self._segment += 1
+                self._file = open(self._segment_path(self._segment), 'ab')
+            offset = self._file.tell()
+            self._file.write(data)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            return self._segment, offset, len(data)
+
+    def _get_map(self, segment: int, end: int) -> mmap.mmap:
+        segment_map = self._maps.get(segment)
+        if segment_map is None or len(segment_map) < end:  # Segment grown since it was mapped
+            if segment_map is not None:
+                segment_map.close()
+            with open(self._segment_path(segment), 'rb') as f:
+                segment_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[segment] = segment_map
+        return segment_map
+
+    def read(self, segment: int, offset: int, size: int, model: type = Block) -> StorableModel:
+        with self._lock:
+            data = self._get_map(segment, offset + size)[offset:offset + size]
+        return model.undump(data)
@@ -0,0 +1,90 @@
+from app.backend.database.miner import BLOCK_HASH_PREFIX
+from dataclasses import dataclass
+
+BLOCK_WORK = 16 ** len(BLOCK_HASH_PREFIX)  # Expected count of hashes to mine block
+
+
+@dataclass(slots=True)
+class TreeNode:
+    hash: str
+    previous_hash: str
+    height: int
+    work: int  # Cumulative work of chain ending with block
+    invalid: bool = False
+
+
+class BlockTree:
+    """Index of all stored blocks, of main chain and of side branches, kept in memory
+
+    Only links between blocks are kept, so fork point of two chains and
+    their work are found without reading blocks. Hashes of invalid blocks
+    are remembered apart from nodes, so they are kept when tree is reloaded.
+    """
+
+    def __init__(self):
+        self._nodes: dict[str, TreeNode] = {}
+        self._invalid: set[str] = set()
+
+    def __contains__(self, block_hash: str) -> bool:
+        return block_hash in self._nodes
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+    def get(self, block_hash: str) -> TreeNode | None:
+        return self._nodes.get(block_hash)
+
+    def add(self, block_hash: str, previous_hash: str) -> TreeNode | None:
+        """Return None if parent is unknown. Block on invalid branch is invalid too"""
+        if block_hash in self._nodes:
+            return self._nodes[block_hash]
+        parent = self._nodes.get(previous_hash)
+        if parent is None and previous_hash != '':
+            return
+        node = TreeNode(
+            hash=block_hash,
+            previous_hash=previous_hash,
+            height=0 if parent is None else parent.height + 1,
+            work=BLOCK_WORK + (0 if parent is None else parent.work),
+            invalid=block_hash in self._invalid or (parent is not None and parent.invalid)
+        )
+        self._nodes[block_hash] = node
+        return node
+
+    def remove(self, block_hash: str):
+        self._nodes.pop(block_hash, None)
+
+    def clear(self):
+        """Remove all nodes, invalid hashes are kept"""
+        self._nodes.clear()
+
+    def invalidate(self, block_hash: str):
+        self._invalid.add(block_hash)
+        node = self._nodes.get(block_hash)
+        if node is not None:
+            node.invalid = True
+
+    def is_invalid(self, block_hash: str) -> bool:
+        """Block is known to be invalid or is on invalid branch"""
+        node = self._nodes.get(block_hash)
+        return block_hash in self._invalid or (node is not None and node.invalid)
+
+    def find_fork(self, first_hash: str, second_hash: str) -> TreeNode | None:
+        """Last common block of two chains, None if they have different genesis"""
+        first, second = self._nodes.get(first_hash), self._nodes.get(second_hash)
+        while first is not None and second is not None and first.hash != second.hash:
+            if first.height >= second.height:
+                first = self._nodes.get(first.previous_hash)
+            else:
+                second = self._nodes.get(second.previous_hash)
+        if first is not None and second is not None:
+            return first
+
+    def get_branch(self, fork_hash: str, tip_hash: str) -> list[TreeNode]:
+        """Blocks after fork block up to tip, from oldest to newest"""
+        branch = []
+        node = self._nodes.get(tip_hash)
+        while node is not None and node.hash != fork_hash:
+            branch.append(node)
+            node = self._nodes.get(node.previous_hash)
+        return branch[::-1]
@@ -1,52 +1,96 @@
 from app.backend.database.models import StorableModel
-import pickle
+from app.backend.database.storage import StorageBackend, LogStorage
+from app.backend.database.sqlite import SQLiteStorage
+from contextlib import contextmanager
+import threading
 import os
 
 DB_FILENAME = os.getenv('DB_FILENAME', 'db')
+DB_BACKEND = os.getenv('DB_BACKEND', 'log')  # log or sqlite
+
+
+def make_storage_backend(backend: str = DB_BACKEND, filename: str = DB_FILENAME) -> StorageBackend:
+    if backend == 'log':
+        return LogStorage(filename)
+    if backend == 'sqlite':
+        return SQLiteStorage(filename + '.sqlite3')
+    raise ValueError(f"Unknown database backend {backend}")
 
 
 class DatabaseService:
-    def __init__(self):
-        self.tables = {}
-        try:
-            with open(DB_FILENAME, 'rb') as f:
-                self.tables = dict(pickle.load(f))
-        except (FileNotFoundError, EOFError):
-            pass
+    """Tables of models in storage backend, selected by DB_BACKEND
+
+    Mutations made inside `batch()` are committed at once when it exits.
+    Equality filters of `find` use backend indexes of attributes listed in model `__indexes__`.
+    """
+
+    def __init__(self, backend: StorageBackend = None):
+        self.backend = make_storage_backend() if backend is None else backend
+        self._lock = threading.RLock()
+        self._batch_depth = 0
+        self._batch_changed = False  # Outer batch has mutations
+        self._rollback_callbacks = []
 
-    def _get_next_id(self, table_name) -> int:
-        return max(self.tables.get(table_name, {}).keys(), default=0) + 1
+    @contextmanager
+    def batch(self):
+        """Buffer mutations and commit them with one durable write
+
+        If exception raised inside, all mutations made in the batch are rolled back.
+        Batches can be nested, inner batch is committed with the outer one.
+        """
+        with self._lock:
+            outer = self._batch_depth == 0
+            if outer:
+                self.backend.begin()
+                self._batch_changed = False
+            else:
+                savepoint = self.backend.savepoint()
+            self._batch_depth += 1
+            try:
+                yield self
+            except BaseException:
+                self._batch_depth -= 1
+                if outer:
+                    self.backend.rollback()
+                    if self._batch_changed:
+                        for callback in self._rollback_callbacks:
+                            callback()
+                else:
+                    self.backend.rollback_to(savepoint)
+                raise
+            self._batch_depth -= 1
+            if outer:
+                self.backend.commit()
+            else:
+                self.backend.release(savepoint)
+
+    def on_rollback(self, callback):
+        """Call callback after outer batch with mutations is rolled back, e.g. to reload state kept in memory"""
+        self._rollback_callbacks.append(callback)
 
     def save(self, model: StorableModel) -> int:
-        if hasattr(model, 'id'):
-            model_id = model.id
-        else:
-            model_id = self._get_next_id(model.table_name)
-            model.id = model_id
-
-        if model.table_name not in self.tables.keys():
-            self.tables[model.table_name] = {}
-        self.tables[model.table_name][model_id] = model
-        with open(DB_FILENAME, 'wb+') as f:
-            pickle.dump(list(self.tables.items()), f)
+        with self._lock:
+            if hasattr(model, 'id'):
+                model_id = model.id
+            else:
+                model_id = self.backend.next_id(model.table_name)
+                model.id = model_id
+            self.backend.save(model.table_name, model_id, model)
+            self._batch_changed = True
         return model_id
 
     def update(self, model_id, model: StorableModel):
-        self.tables[model.table_name][model_id] = model
-        with open(DB_FILENAME, 'wb+') as f:
-            pickle.dump(list(self.tables.items()), f)
+        with self._lock:
+            self.backend.save(model.table_name, model_id, model)
+            self._batch_changed = True
 
     def get(self, table_name, model_id: int) -> dict | None:
-        return self.tables.get(table_name, {}).get(model_id)
+        return self.backend.get(table_name, model_id)
 
     def delete(self, table_name, model_id: int):
-        try:
-            ret = self.tables.get(table_name, {}).pop(model_id)
-        except KeyError:
-            return
-        with open(DB_FILENAME, 'wb+') as f:
-            pickle.dump(list(self.tables.items()), f)
-        return ret
+        with self._lock:
+            self._batch_changed = True
+            return self.backend.delete(table_name, model_id)
 
     @staticmethod
     def _filter(objects, **filters):
@@ -57,7 +101,7 @@ class DatabaseService:
 
     def find(self, table_name, subfilters: dict[str, dict] = None, **filters) -> list[dict]:
         found = list(self._filter(
-            list(self.tables.get(table_name, {}).values()).copy(),
+            self.backend.find(table_name, filters),
             **filters
         ))
         if subfilters:
@@ -66,4 +110,3 @@ class DatabaseService:
                     if not list(self._filter(getattr(obj, attr, []), **attr_filters)):
                         found.remove(obj)
         return found
-
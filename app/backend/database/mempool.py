@@ -0,0 +1,173 @@
+from app.backend.database.models import Transaction, TransactionUndo, UTXO
+from collections import OrderedDict
+import os
+
+MEMPOOL_MAX_COUNT = int(os.getenv('MEMPOOL_MAX_COUNT', '5000'))
+MEMPOOL_MAX_SIZE = int(os.getenv('MEMPOOL_MAX_SIZE', str(4 * 1024 * 1024)))
+
+
+class Mempool:
+    """Transactions waiting for block, their changes of utxos are applied to utxo set
+
+    Pool keeps order of adding, so parents are always before their children.
+    Outpoints spent by pool transactions are indexed, so double spend is found by one lookup.
+    When pool exceeds count or size limit, oldest transactions are evicted with their descendants.
+    Listeners are notified by `tx_added(tx)`, `txs_removed(txs)` and `pool_reloaded()`.
+    """
+
+    def __init__(
+            self,
+            db_service,
+            utxo_set,
+            max_count: int = MEMPOOL_MAX_COUNT,
+            max_size: int = MEMPOOL_MAX_SIZE
+    ):
+        self.db_service = db_service
+        self.utxo_set = utxo_set
+        self.max_count = max_count
+        self.max_size = max_size
+        self.size = 0  # Bytes of encoded transactions
+
+        self._entries: OrderedDict[str, tuple[Transaction, int]] = OrderedDict()  # id -> (tx, size)
+        self._spenders: dict[tuple[str, int], str] = {}  # outpoint -> id of spending transaction
+        self._listeners = []
+        self._load()
+        self.db_service.on_rollback(self._load)  # Indexes must follow database
+
+    def _load(self):
+        self._entries.clear()
+        self._spenders.clear()
+        self.size = 0
+        for tx in self.db_service.find(Transaction.table_name):
+            self._index(tx)
+        for listener in self._listeners:
+            listener.pool_reloaded()
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def _index(self, tx: Transaction):
+        size = len(tx.dump())
+        self._entries[tx.id] = (tx, size)
+        self.size += size
+        for inp in tx.inputs:
+            self._spenders[(inp.tx_id, inp.output_index)] = tx.id
+
+    def _unindex(self, tx: Transaction):
+        _, size = self._entries.pop(tx.id)
+        self.size -= size
+        for inp in tx.inputs:
+            if self._spenders.get((inp.tx_id, inp.output_index)) == tx.id:
+                del self._spenders[(inp.tx_id, inp.output_index)]
+
+    def __contains__(self, tx_id: str) -> bool:
+        return tx_id in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, tx_id: str) -> Transaction | None:
+        entry = self._entries.get(tx_id)
+        if entry is not None:
+            return entry[0]
+
+    def get_spender(self, tx_id: str, output_index: int) -> str | None:
+        return self._spenders.get((tx_id, output_index))
+
+    def get_chain_utxo(self, tx_id: str, output_index: int) -> UTXO | None:
+        """Output unspent by chain, as if pool changes of utxos were not applied"""
+        if tx_id in self._entries:
+            return
+        utxo = self.utxo_set.lookup(tx_id, output_index)
+        if utxo is not None:
+            return utxo
+        spender = self._spenders.get((tx_id, output_index))
+        if spender is None:
+            return
+        undo = self.db_service.get(TransactionUndo.table_name, spender)
+        return next((u for u in undo.spent if (u.tx_id, u.output_index) == (tx_id, output_index)), None)
+
+    def get_conflicts(self, tx: Transaction) -> set[str]:
+        """Pool transactions spending the same outpoints as transaction"""
+        conflicts = {self._spenders.get((inp.tx_id, inp.output_index)) for inp in tx.inputs}
+        conflicts.discard(None)
+        conflicts.discard(tx.id)
+        return conflicts
+
+    def select(self, max_txs: int | None = None) -> list[Transaction]:
+        """Oldest transactions, every transaction is after its parents from pool"""
+        selected = []
+        for tx, _ in self._entries.values():
+            if max_txs is not None and len(selected) >= max_txs:
+                break
+            selected.append(tx)
+        return selected
+
+    def add(self, tx: Transaction) -> list[Transaction]:
+        """Add validated transaction and apply its changes of utxos
+
+        Return transactions evicted to fit limits.
+        """
+        with self.db_service.batch():
+            spent, created = self.utxo_set.apply([tx])
+            self.db_service.save(tx)
+            self.db_service.save(TransactionUndo(id=tx.id, spent=spent, created=created))
+        self._index(tx)
+        for listener in self._listeners:
+            listener.tx_added(tx)
+        evicted = []
+        while self._entries and (len(self._entries) > self.max_count or self.size > self.max_size):
+            evicted.extend(self.remove([next(iter(self._entries))]))
+        return evicted
+
+    def _get_descendants(self, tx_ids: set[str]) -> set[str]:
+        found = set(tx_ids)
+        queue = list(tx_ids)
+        while queue:
+            tx = self._entries[queue.pop()][0]
+            for output_index in range(len(tx.outputs)):
+                spender = self._spenders.get((tx.id, output_index))
+                if spender is not None and spender not in found:
+                    found.add(spender)
+                    queue.append(spender)
+        return found
+
+    def remove(self, tx_ids: list[str]) -> list[Transaction]:
+        """Remove transactions with their descendants and revert their changes of utxos
+
+        Return removed transactions in order of adding.
+        """
+        removing = self._get_descendants({tx_id for tx_id in tx_ids if tx_id in self._entries})
+        removed = [tx for tx_id, (tx, _) in self._entries.items() if tx_id in removing]
+        with self.db_service.batch():
+            for tx in removed[::-1]:  # Revert in reverse order of applying
+                self._revert(tx)
+                self.db_service.delete(Transaction.table_name, tx.id)
+        for tx in removed:
+            self._unindex(tx)
+        if removed:
+            for listener in self._listeners:
+                listener.txs_removed(removed)
+        return removed
+
+    def remove_related(self, txs: list[Transaction]) -> list[Transaction]:
+        """Remove transactions of block from pool before its changes of utxos are applied or reverted
+
+        Pool transactions spending the same outpoints or spending outputs of transactions
+        are removed too, with their descendants. Return removed transactions, which are not in txs.
+        """
+        tx_ids = set()
+        for tx in txs:
+            tx_ids.add(tx.id)
+            tx_ids |= self.get_conflicts(tx)
+            tx_ids.update(self._spenders.get((tx.id, i)) for i in range(len(tx.outputs)))
+        tx_ids.discard(None)
+        block_tx_ids = {tx.id for tx in txs}
+        return [tx for tx in self.remove(list(tx_ids)) if tx.id not in block_tx_ids]
+
+    def clear(self) -> list[Transaction]:
+        return self.remove(list(self._entries))
+
+    def _revert(self, tx: Transaction):
+        undo = self.db_service.delete(TransactionUndo.table_name, tx.id)
+        self.utxo_set.undo(undo.spent, undo.created)
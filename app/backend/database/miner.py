@@ -0,0 +1,130 @@
+from app.backend.database.models import Block
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from hashlib import sha256
+import multiprocessing
+import threading
+import time
+import os
+
+MINER_PROCESSES = int(os.getenv('MINER_PROCESSES', str(os.cpu_count() or 1)))
+MINER_CHUNK_SIZE = int(os.getenv('MINER_CHUNK_SIZE', '100000'))
+BLOCK_HASH_PREFIX = '00'
+_CANCEL_CHECK_INTERVAL = 4096
+
+_cancel_event = None  # Set in worker processes by pool initializer
+
+
+def _init_worker(cancel_event):
+    global _cancel_event
+    _cancel_event = cancel_event
+
+
+def _search(header: bytes, start: int, stop: int, cancel_event=None) -> tuple[int | None, int]:
+    """Return (found nonce or None, count of tried nonces)
+
+    header: block header without nonce
+    """
+    cancel_event = _cancel_event if cancel_event is None else cancel_event
+    base = sha256(header)
+    for nonce in range(start, stop):
+        if (nonce - start) % _CANCEL_CHECK_INTERVAL == 0 and cancel_event.is_set():
+            return None, nonce - start
+        hasher = base.copy()
+        hasher.update(nonce.to_bytes(8))
+        if hasher.hexdigest().startswith(BLOCK_HASH_PREFIX):
+            return nonce, nonce - start + 1
+    return None, stop - start
+
+
+class MinerService:
+    """Proof of work search over nonce space split in chunks between worker processes
+
+    Block header without nonce is hashed once, every nonce only updates its copy.
+    Mining of block can be cancelled from another thread, e.g. when block
+    with the same parent is received from network.
+    """
+
+    def __init__(self, processes: int = MINER_PROCESSES, chunk_size: int = MINER_CHUNK_SIZE):
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self.hashrate = 0.0  # Hashes per second of last mining
+        # Workers must not re-run main module of node, which happens with spawn
+        start_method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn'
+        self._context = multiprocessing.get_context(start_method)
+        self._cancel_event = self._context.Event()
+        self._executor = None
+        if self.processes > 1:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.processes,
+                mp_context=self._context,
+                initializer=_init_worker,
+                initargs=(self._cancel_event,)
+            )
+            self._executor.submit(int).result()  # With fork all workers are started by first task
+        self._lock = threading.Lock()
+        self._mining_parent = None
+
+    def cancel(self, parent_hash: str | None = None):
+        """Stop mining of block on given parent or any block if parent is None"""
+        mining_parent = self._mining_parent
+        if mining_parent is not None and parent_hash in (None, mining_parent):
+            self._cancel_event.set()
+
+    def mine(self, block: Block) -> Block | None:
+        """Set nounce of block with valid hash. Return None if mining was cancelled"""
+        with self._lock:
+            self._cancel_event.clear()
+            self._mining_parent = block.previous_hash
+            started = time.perf_counter()
+            try:
+                nonce, tried = self._search(block)
+            finally:
+                self._mining_parent = None
+            elapsed = time.perf_counter() - started
+            self.hashrate = tried / elapsed if elapsed else 0.0
+        print(f"Mined {tried} hashes in {elapsed:.3f}s, {self.hashrate:.0f} H/s")
+        if nonce is None:
+            print("Mining cancelled")
+            return
+        block.nounce = nonce
+        return block
+
+    def _search(self, block: Block) -> tuple[int | None, int]:
+        header = block.pack_header()
+        if self.processes <= 1:
+            tried = 0
+            start = block.nounce
+            while not self._cancel_event.is_set():
+                nonce, chunk_tried = _search(header, start, start + self.chunk_size, self._cancel_event)
+                tried += chunk_tried
+                if nonce is not None:
+                    return nonce, tried
+                start += self.chunk_size
+            return None, tried
+
+        executor = self._executor
+        next_start = block.nounce
+        pending = set()
+        tried = 0
+        found = None
+        while found is None and not self._cancel_event.is_set():
+            while len(pending) < self.processes * 2:
+                pending.add(executor.submit(_search, header, next_start, next_start + self.chunk_size))
+                next_start += self.chunk_size
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                nonce, chunk_tried = future.result()
+                tried += chunk_tried
+                if nonce is not None and (found is None or nonce < found):
+                    found = nonce
+        self._cancel_event.set()  # Stop chunks in progress
+        for future in pending:
+            future.cancel()
+        for future in wait(pending).done:
+            if not future.cancelled():
+                tried += future.result()[1]
+        return found, tried
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
@@ -4,58 +4,180 @@ from hashlib import sha256
 from uuid import UUID
 from app.backend.utils import asdict
 from dataclasses import dataclass, field
+from functools import cached_property
+import struct
 
 max_int64 = 0xFFFFFFFFFFFFFFFF
+RECORD_VERSION = 1
+_EPOCH = dt.datetime(1970, 1, 1, tzinfo=dt.UTC)
+_models: dict[str, type] = {}
+
+
+def _unpack(fmt: str, data: bytes, offset: int) -> tuple[tuple, int]:
+    return struct.unpack_from(fmt, data, offset), offset + struct.calcsize(fmt)
+
+
+def _unpack_hash(value: bytes) -> str:
+    return value.rstrip(b'\x00').decode()
+
+
+def _timestamp_to_microseconds(timestamp: dt.datetime) -> int:
+    if timestamp.tzinfo is None:  # Naive time is treated as UTC
+        timestamp = timestamp.replace(tzinfo=dt.UTC)
+    return (timestamp - _EPOCH) // dt.timedelta(microseconds=1)
+
+
+def merkle_root(hashes: list[bytes]) -> bytes:
+    """Root of tree where every node is double sha256 of its children, odd node is paired with itself"""
+    if not hashes:
+        return b'\x00' * 32
+    while len(hashes) > 1:
+        if len(hashes) % 2:
+            hashes = hashes + hashes[-1:]
+        hashes = [sha256(sha256(hashes[i] + hashes[i + 1]).digest()).digest() for i in range(0, len(hashes), 2)]
+    return hashes[0]
 
 
-@dataclass
 class StorableModel:
+    """Stored as versioned binary record: version byte + packed model"""
+    __indexes__ = ()  # Attributes for DatabaseService secondary indexes
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        _models[cls.__name__.lower()] = cls
+
     @classmethod
     @property
     def table_name(cls):
         return cls.__name__.lower()
 
+    @staticmethod
+    def get_model(table_name: str) -> type:
+        return _models[table_name]
+
+    def pack(self) -> bytes:
+        raise NotImplementedError
+
+    @classmethod
+    def unpack(cls, data: bytes, offset: int = 0) -> tuple[object, int]:
+        """Return object and offset of its end"""
+        raise NotImplementedError
+
     def dump(self) -> bytes:
         """Serialize object to bytes for storing and transfer"""
-        return ''.join([str(v) for k, v in self.__dict__.items()]).encode()
+        return struct.pack('>B', RECORD_VERSION) + self.pack()
 
     @classmethod
     def undump(cls, rawdata: bytes) -> object:
         """Construct object from serialize bytes"""
-        raise NotImplementedError
+        (version,), offset = _unpack('>B', rawdata, 0)
+        if version != RECORD_VERSION:
+            raise ValueError(f"Unsupported record version {version}")
+        return cls.unpack(rawdata, offset)[0]
 
 
-@dataclass
+@dataclass(frozen=True)
 class TXInput:
     tx_id: str
     output_index: int
     unlock_script: bytes
 
+    def pack(self) -> bytes:
+        return struct.pack(
+            f'>64sHQ{len(self.unlock_script)}s',
+            self.tx_id.encode(),
+            self.output_index,
+            len(self.unlock_script),
+            self.unlock_script
+        )
+
+    @classmethod
+    def unpack(cls, data: bytes, offset: int = 0) -> tuple['TXInput', int]:
+        (tx_id, output_index, script_size), offset = _unpack('>64sHQ', data, offset)
+        unlock_script = data[offset:offset + script_size]
+        return cls(tx_id=_unpack_hash(tx_id), output_index=output_index, unlock_script=unlock_script), offset + script_size
+
     def __str__(self):
         return f'Input. TX id={self.tx_id} Output={self.output_index}'
 
 
-@dataclass
+@dataclass(frozen=True)
 class TXOutput:
     input_index: int
     lock_script: bytes
     value: bytes
 
+    def pack(self) -> bytes:
+        return struct.pack(
+            f'>HQ{len(self.value)}sQ{len(self.lock_script)}s',
+            self.input_index,
+            len(self.value),
+            self.value,
+            len(self.lock_script),
+            self.lock_script
+        )
+
+    @classmethod
+    def unpack(cls, data: bytes, offset: int = 0) -> tuple['TXOutput', int]:
+        (input_index, value_size), offset = _unpack('>HQ', data, offset)
+        value = data[offset:offset + value_size]
+        (script_size,), offset = _unpack('>Q', data, offset + value_size)
+        lock_script = data[offset:offset + script_size]
+        return cls(input_index=input_index, lock_script=lock_script, value=value), offset + script_size
+
+    @property
+    def address(self) -> bytes | None:
+        """Receiver address of pay-to-address output"""
+        from app.backend.database.script import ScriptService  # Script module depends on models
+        return ScriptService.get_lock_script_address(self.lock_script)
+
     def __str__(self):
         return f'Output. Input={self.input_index} Value={self.value}'
 
 
-@dataclass
+@dataclass(frozen=True)
 class Transaction(StorableModel):
-    inputs: list[TXInput]
-    outputs: list[TXOutput]
+    """Immutable, so its hashes are computed once. Inputs and outputs are stored as tuples"""
+    inputs: tuple[TXInput, ...]
+    outputs: tuple[TXOutput, ...]
 
-    def encode(self):  # TODO change
-        return sha256(f'{self.inputs}{self.outputs}'.encode()).digest()
+    def __post_init__(self):
+        object.__setattr__(self, 'inputs', tuple(self.inputs))
+        object.__setattr__(self, 'outputs', tuple(self.outputs))
 
-    @property
+    @cached_property
+    def _digest(self) -> bytes:
+        return sha256(self.dump()).digest()
+
+    def encode(self) -> bytes:
+        """Hash of canonical versioned encoding, signed by spenders of transaction outputs"""
+        return self._digest
+
+    @cached_property
     def id(self) -> str:
-        return sha256(sha256(self.encode()).digest()).hexdigest()
+        return sha256(self.encode()).hexdigest()
+
+    def pack(self) -> bytes:
+        """Same layout as NetworkTransaction"""
+        outputs_encoded = b''.join([out.pack() for out in self.outputs])
+        inputs_encoded = b''.join([inp.pack() for inp in self.inputs])
+        return struct.pack('>Q', len(outputs_encoded)) + outputs_encoded \
+            + struct.pack('>Q', len(inputs_encoded)) + inputs_encoded
+
+    @classmethod
+    def unpack(cls, data: bytes, offset: int = 0) -> tuple['Transaction', int]:
+        outputs, inputs = [], []
+        (outputs_size,), offset = _unpack('>Q', data, offset)
+        end = offset + outputs_size
+        while offset < end:
+            out, offset = TXOutput.unpack(data, offset)
+            outputs.append(out)
+        (inputs_size,), offset = _unpack('>Q', data, offset)
+        end = offset + inputs_size
+        while offset < end:
+            inp, offset = TXInput.unpack(data, offset)
+            inputs.append(inp)
+        return cls(inputs=inputs, outputs=outputs), offset
 
     @classmethod
     def from_network_model(cls, model):
@@ -69,13 +191,152 @@ class Transaction(StorableModel):
 
 
 @dataclass
-class UTXOs(StorableModel):
-    transaction_id: str
-    outputs_indexes: list[int]
-    transaction: Transaction
+class UTXO(StorableModel):
+    """Unspent transaction output addressed by outpoint"""
+    __indexes__ = ('tx_id', 'address')
+
+    tx_id: str
+    output_index: int
+    output: TXOutput
+    tx_hash: bytes  # Transaction.encode() of output transaction, message signed by spender
+
+    @staticmethod
+    def make_id(tx_id: str, output_index: int) -> str:
+        return f'{tx_id}:{output_index}'
+
+    @property
+    def id(self) -> str:
+        return self.make_id(self.tx_id, self.output_index)
+
+    @property
+    def address(self) -> bytes | None:
+        return self.output.address
+
+    @classmethod
+    def from_transaction(cls, tx: Transaction, output_index: int) -> 'UTXO':
+        return cls(tx_id=tx.id, output_index=output_index, output=tx.outputs[output_index], tx_hash=tx.encode())
+
+    def pack(self) -> bytes:
+        return struct.pack('>64sH32s', self.tx_id.encode(), self.output_index, self.tx_hash) + self.output.pack()
+
+    @classmethod
+    def unpack(cls, data: bytes, offset: int = 0) -> tuple['UTXO', int]:
+        (tx_id, output_index, tx_hash), offset = _unpack('>64sH32s', data, offset)
+        output, offset = TXOutput.unpack(data, offset)
+        return cls(tx_id=_unpack_hash(tx_id), output_index=output_index, output=output, tx_hash=tx_hash), offset
 
     def __str__(self):
-        return f'indexes: {self.outputs_indexes}\n{str(self.transaction)}'
+        return f'UTXO {self.id}\n\t{str(self.output)}'
+
+
+@dataclass
+class BlockUndo(StorableModel):
+    """Changes of UTXO set made by block: spent outputs and created outpoints"""
+    id: str  # Block hash
+    spent: list[UTXO]
+    created: list[tuple[str, int]]
+
+    def pack(self) -> bytes:
+        spent_encoded = b''.join([utxo.pack() for utxo in self.spent])
+        created_encoded = b''.join([struct.pack('>64sH', tx_id.encode(), i) for tx_id, i in self.created])
+        return struct.pack('>64sII', self.id.encode(), len(self.spent), len(self.created)) \
+            + spent_encoded + created_encoded
+
+    @classmethod
+    def unpack(cls, data: bytes, offset: int = 0) -> tuple['BlockUndo', int]:
+        (model_id, spent_count, created_count), offset = _unpack('>64sII', data, offset)
+        spent, created = [], []
+        for _ in range(spent_count):
+            utxo, offset = UTXO.unpack(data, offset)
+            spent.append(utxo)
+        for _ in range(created_count):
+            (tx_id, output_index), offset = _unpack('>64sH', data, offset)
+            created.append((_unpack_hash(tx_id), output_index))
+        return cls(id=_unpack_hash(model_id), spent=spent, created=created), offset
+
+
+@dataclass
+class TransactionUndo(BlockUndo):
+    """Changes of UTXO set made by transaction in pool"""
+    id: str  # Transaction id
+
+
+@dataclass
+class TransactionLocation(StorableModel):
+    """Position of stored transaction in chain"""
+    id: str  # Transaction id
+    block_hash: str
+    position: int
+
+    def pack(self) -> bytes:
+        return struct.pack('>64s64sI', self.id.encode(), self.block_hash.encode(), self.position)
+
+    @classmethod
+    def unpack(cls, data: bytes, offset: int = 0) -> tuple['TransactionLocation', int]:
+        (tx_id, block_hash, position), offset = _unpack('>64s64sI', data, offset)
+        return cls(id=_unpack_hash(tx_id), block_hash=_unpack_hash(block_hash), position=position), offset
+
+
+@dataclass
+class BlockIndex(StorableModel):
+    """Location of stored block and of its undo record in block files"""
+    __indexes__ = ('previous_hash',)
+
+    id: str  # Block hash
+    previous_hash: str
+    segment: int
+    offset: int
+    size: int
+    height: int
+    undo_segment: int = 0
+    undo_offset: int = 0
+    undo_size: int = 0  # 0 if block is not connected to chain
+
+    def pack(self) -> bytes:
+        return struct.pack(
+            '>64s64sIQQQIQQ',
+            self.id.encode(),
+            self.previous_hash.encode(),
+            self.segment,
+            self.offset,
+            self.size,
+            self.height,
+            self.undo_segment,
+            self.undo_offset,
+            self.undo_size
+        )
+
+    @classmethod
+    def unpack(cls, data: bytes, offset: int = 0) -> tuple['BlockIndex', int]:
+        (
+            block_hash, previous_hash, segment, block_offset, size, height, undo_segment, undo_offset, undo_size
+        ), offset = _unpack('>64s64sIQQQIQQ', data, offset)
+        return cls(
+            id=_unpack_hash(block_hash),
+            previous_hash=_unpack_hash(previous_hash),
+            segment=segment,
+            offset=block_offset,
+            size=size,
+            height=height,
+            undo_segment=undo_segment,
+            undo_offset=undo_offset,
+            undo_size=undo_size
+        ), offset
+
+
+@dataclass
+class BlockHeight(StorableModel):
+    """Hash of block at height in chain"""
+    id: int  # Height, genesis block has 0
+    hash: str
+
+    def pack(self) -> bytes:
+        return struct.pack('>Q64s', self.id, self.hash.encode())
+
+    @classmethod
+    def unpack(cls, data: bytes, offset: int = 0) -> tuple['BlockHeight', int]:
+        (height, block_hash), offset = _unpack('>Q64s', data, offset)
+        return cls(id=height, hash=_unpack_hash(block_hash)), offset
 
 
 @dataclass
@@ -83,6 +344,14 @@ class Tip(StorableModel):
     value: str
     id: str = 'tip'
 
+    def pack(self) -> bytes:
+        return struct.pack('>64s', self.value.encode())
+
+    @classmethod
+    def unpack(cls, data: bytes, offset: int = 0) -> tuple['Tip', int]:
+        (value,), offset = _unpack('>64s', data, offset)
+        return cls(value=_unpack_hash(value)), offset
+
 
 @dataclass
 class Key:
@@ -95,34 +364,86 @@ class Key:
     def hexaddress(self):
         return hex(int.from_bytes(self.address))[2:]
 
+    @staticmethod
+    def address_from_hex(hexaddress: str) -> bytes:
+        """Inverse of hexaddress, which drops leading zeros"""
+        return int(hexaddress, 16).to_bytes(32)
+
 
 @dataclass
 class _BlockParent(StorableModel):
-    transactions: list[Transaction]
+    transactions: tuple[Transaction, ...]
     previous_hash: str
     timestamp: dt.datetime = field(default_factory=dt.datetime.now)
     nounce: int = 0
     id: str = field(init=False)
     hash: str = field(init=False)
 
+    def __post_init__(self):
+        self.transactions = tuple(self.transactions)  # Merkle root is cached
+
 
 class Block(_BlockParent):
     def get_now_time():
         return dt.datetime.now(dt.UTC)
 
-    transactions: list[Transaction]
+    transactions: tuple[Transaction, ...]
     previous_hash: str
     timestamp: dt.datetime = field(default_factory=get_now_time)
     nounce: int = 0
 
+    @cached_property
+    def merkle_root(self) -> bytes:
+        """Transactions must not be changed after it is computed"""
+        return merkle_root([bytes.fromhex(tx.id) for tx in self.transactions])
+
+    def pack_header(self) -> bytes:
+        """Fixed size header without nounce: previous hash, merkle root, timestamp"""
+        return struct.pack(
+            '>64s32sq',
+            self.previous_hash.encode(),
+            self.merkle_root,
+            _timestamp_to_microseconds(self.timestamp)
+        )
+
+    @property
+    def header(self) -> bytes:
+        return self.pack_header() + struct.pack('>Q', self.nounce)
+
     @property
     def hash(self):
-        return sha256(f'{self.transactions}{self.previous_hash}{self.timestamp}{self.nounce}'.encode()).hexdigest()
+        return sha256(self.header).hexdigest()
 
     @property
     def id(self):
         return self.hash
 
+    def pack(self) -> bytes:
+        """Layout of NetworkBlock with exact timestamp in microseconds"""
+        txs_encoded = b''.join([tx.pack() for tx in self.transactions])
+        return struct.pack(
+            '>qQ64sQ',
+            _timestamp_to_microseconds(self.timestamp),
+            self.nounce,
+            self.previous_hash.encode(),
+            len(txs_encoded)
+        ) + txs_encoded
+
+    @classmethod
+    def unpack(cls, data: bytes, offset: int = 0) -> tuple['Block', int]:
+        (timestamp, nounce, previous_hash, txs_size), offset = _unpack('>qQ64sQ', data, offset)
+        transactions = []
+        end = offset + txs_size
+        while offset < end:
+            tx, offset = Transaction.unpack(data, offset)
+            transactions.append(tx)
+        return cls(
+            transactions=transactions,
+            previous_hash=_unpack_hash(previous_hash),
+            timestamp=_EPOCH + dt.timedelta(microseconds=timestamp),
+            nounce=nounce
+        ), offset
+
     @classmethod
     def from_network_model(cls, model):
         txs = []
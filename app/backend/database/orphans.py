@@ -0,0 +1,79 @@
+from app.backend.database.models import Block
+from collections import OrderedDict
+import threading
+import time
+import os
+
+ORPHANS_MAX_COUNT = int(os.getenv('ORPHANS_MAX_COUNT', '100'))
+ORPHANS_MAX_SIZE = int(os.getenv('ORPHANS_MAX_SIZE', str(8 * 1024 * 1024)))
+ORPHANS_EXPIRY = float(os.getenv('ORPHANS_EXPIRY', '600'))
+
+
+class OrphanPool:
+    """Blocks received before their parent, grouped by hash of missing parent
+
+    Pool is bounded by count and by size of encoded blocks, oldest orphans are evicted first.
+    Orphans whose parent did not arrive in expiry seconds are dropped.
+    """
+
+    def __init__(
+            self,
+            max_count: int = ORPHANS_MAX_COUNT,
+            max_size: int = ORPHANS_MAX_SIZE,
+            expiry: float = ORPHANS_EXPIRY
+    ):
+        self.max_count = max_count
+        self.max_size = max_size
+        self.expiry = expiry
+        self.size = 0  # Bytes of encoded orphans
+
+        self._orphans: OrderedDict[str, tuple[Block, int, float]] = OrderedDict()  # hash -> (block, size, added at)
+        self._by_parent: dict[str, set[str]] = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, block_hash: str) -> bool:
+        return block_hash in self._orphans
+
+    def __len__(self) -> int:
+        return len(self._orphans)
+
+    def add(self, block: Block) -> bool:
+        """Return False if block is already in pool or is too big for it"""
+        size = len(block.dump())
+        with self._lock:
+            self._expire()
+            if block.hash in self._orphans or size > self.max_size:
+                return False
+            self._orphans[block.hash] = (block, size, time.monotonic())
+            self._by_parent.setdefault(block.previous_hash, set()).add(block.hash)
+            self.size += size
+            while len(self._orphans) > self.max_count or self.size > self.max_size:
+                self._remove(next(iter(self._orphans)))
+        return True
+
+    def pop_children(self, parent_hash: str) -> list[Block]:
+        """Remove and return orphans waiting for parent, from oldest"""
+        with self._lock:
+            self._expire()
+            hashes = self._by_parent.get(parent_hash, ())
+            children = [block for block, _, _ in sorted((self._orphans[h] for h in hashes), key=lambda o: o[2])]
+            for block in children:
+                self._remove(block.hash)
+        return children
+
+    def _remove(self, block_hash: str):
+        block, size, _ = self._orphans.pop(block_hash)
+        self.size -= size
+        siblings = self._by_parent[block.previous_hash]
+        siblings.discard(block_hash)
+        if not siblings:
+            del self._by_parent[block.previous_hash]
+
+    def _expire(self):
+        expired_at = time.monotonic() - self.expiry
+        while self._orphans:
+            block_hash, (_, _, added) = next(iter(self._orphans.items()))
+            if added > expired_at:
+                break
+            print("Orphan expired", block_hash)
+            self._remove(block_hash)
@@ -1,35 +1,62 @@
-from app.backend.database.models import Block
+from app.backend.database.models import Block, BlockUndo
 from app.backend.database.models import Transaction
-from app.backend.database.models import TXOutput, TXInput, UTXOs
+from app.backend.database.models import TXOutput, TXInput, UTXO
 from app.backend.database.models import ValidateError
 from app.backend.database.models import Key
+from app.backend.database.miner import BLOCK_HASH_PREFIX
+from app.backend.database.script import ScriptError
 import datetime as dt
 from uuid import uuid4
+import time
 
 
 class DatabaseRepository:
-    def __init__(self, block_service, transaction_service, key_service):
+    def __init__(self, block_service, transaction_service, key_service, orphan_pool, block_template):
         self.block_service = block_service
         self.tx_service = transaction_service
         self.key_service = key_service
+        self.orphan_pool = orphan_pool
+        self.block_template = block_template
 
         self._token_to_key: dict[str, Key] = {}
 
     def iterate_blocks(self, stop_hash: str | None = None):
         return self.block_service.iterate_blocks(stop_hash)
 
+    def get_block(self, block_hash: str) -> Block | None:
+        return self.block_service.get_one(block_hash)
+
+    def iterate_blocks_by_height(self, start: int, stop: int):
+        return self.block_service.iterate_heights(start, stop)
+
+    def get_block_by_height(self, height: int) -> Block | None:
+        return self.block_service.get_by_height(height)
+
+    def get_locator(self) -> dict[str, int]:
+        """Exponentially spaced hashes of chain with their heights, from tip to genesis"""
+        return self.block_service.get_locator()
+
+    def find_fork_height(self, locator: list[str]) -> int:
+        return self.block_service.find_fork(locator)
+
+    def get_chain_height(self) -> int:
+        """Height of tip block, -1 if chain is empty"""
+        return self.block_service.get_tip_height()
+
     def find_utxos(
             self,
             transaction_id: str = None,
             output_index: int = None,
             output_lock_script_part: bytes = None,
-            output_value: bytes = None
-    ) -> list[UTXOs]:
+            output_value: bytes = None,
+            address: bytes = None
+    ) -> list[UTXO]:
         return self.tx_service.get_utxos(
             transaction_id,
             output_index,
             output_lock_script_part,
-            output_value
+            output_value,
+            address
         )
 
     def make_transaction(self, inputs: list[TXInput], outputs: list[TXOutput]) -> Transaction:
@@ -47,52 +74,219 @@ class DatabaseRepository:
             previous_hash: str | None = None,
             timestamp: dt.datetime | None = None,
             nounce: int | None = None
-    ) -> Block:
+    ) -> Block | None:
         transactions = [(self.tx_service.make(**tr) if isinstance(tr, dict) else tr) for tr in transactions]
         return self.block_service.make(transactions, previous_hash, timestamp, nounce)
 
-    def generate_block(self) -> Block:
-        """Pop transactions from pool and make block"""
-        transactions = self.tx_service.pop_all()
-        block = self.make_block(transactions)
-        return block
+    def generate_block(self) -> Block | None:
+        """Mine block template of oldest pool transactions, they stay in pool until block is stored
+
+        Return None if mining is cancelled.
+        """
+        return self.block_service.mine(self.block_template.get())
 
     def store_transaction(self, transaction: Transaction):
         """Push transaction to pool"""
         self.tx_service.store(transaction)
-        self.tx_service.create_utxos(transaction)
 
-    def _validate_transactions(self, txs: list):
-        for tx in txs:
-            self.tx_service.delete(tx)
-        for tx in txs:
-            if not self.tx_service.validate(tx):
+    def store_transactions(self, transactions: list[Transaction]) -> list[bool]:
+        """Push valid transactions to pool, scripts are validated in parallel"""
+        return self.tx_service.store_many(transactions)
+
+    def get_script_rejections(self) -> dict[str, int]:
+        """Count of scripts rejected by every exceeded budget limit"""
+        return dict(self.tx_service.validation_service.budget.rejected)
+
+    def _validate_transactions(self, block: Block):
+        """Validate block transactions against chain without pool changes, scripts are validated in parallel
+
+        Nothing is written, so invalid block leaves pool untouched.
+        Inputs verified when transactions entered pool are skipped.
+        """
+        started = time.perf_counter()
+        created: dict[str, UTXO] = {}  # Outputs of earlier transactions of block
+        spent: set[str] = set()
+        groups, keys = [], []
+        for tx in block.transactions:
+            depends = self.tx_service.get_depends(tx, created, lookup=self.tx_service.mempool.get_chain_utxo)
+            if depends is None or not spent.isdisjoint(depends):
+                raise ValidateError("Invalid transactions in block")
+            spent.update(depends)
+            try:
+                checks, tx_keys = self.tx_service.validation_service.get_checks(tx, depends)
+            except ScriptError:
                 raise ValidateError("Invalid transactions in block")
-            self.tx_service.create_utxos(tx)
+            groups.append(checks)
+            keys.append(tx_keys)
+            for output_index in range(len(tx.outputs)):
+                utxo = UTXO.from_transaction(tx, output_index)
+                created[utxo.id] = utxo
+        cache = self.tx_service.validation_service.cache
+        hits = cache.hits
+        if not all(self.tx_service.validation_service.check(groups, keys)):
+            raise ValidateError("Invalid transactions in block")
+        elapsed = time.perf_counter() - started
+        inputs = sum(len(checks) for checks in groups)
+        print(
+            f"Validated block {block.hash}: {len(groups)} transactions, {inputs} inputs "
+            f"({cache.hits - hits} cached) in {elapsed:.3f}s"
+        )
+
+    def _apply_transactions(self, block: Block) -> BlockUndo:
+        """Apply changes of utxos by block transactions in order"""
+        undo = BlockUndo(id=block.hash, spent=[], created=[])
+        for tx in block.transactions:
+            tx_undo = self.tx_service.create_utxos(tx)
+            undo.spent.extend(tx_undo.spent)
+            undo.created.extend(tx_undo.created)
+        return undo
+
+    def _connect_block(self, block: Block, validate_transactions: bool = True) -> str:
+        """Connect block to tip, pool transactions of block or conflicting with it are removed
+
+        Pool is changed only after block is validated.
+        Removed transactions, which are still valid after block, are returned to pool.
+        """
+        with self.block_service.db_service.batch():
+            undo = None
+            removed = []
+            if not self.block_service.validate_block(block):
+                raise ValidateError("Invalid block")
+            if validate_transactions and block.transactions:
+                self._validate_transactions(block)
+                removed = self.tx_service.mempool.remove_related(block.transactions)
+                undo = self._apply_transactions(block)
+
+            block_id = self.block_service.store(block, undo)
+            if block_id is None:
+                raise ValidateError("Invalid block")
+            self._restore_transactions(removed)
+        return block_id
+
+    def _reorganize(self, tip_hash: str):
+        """Switch chain to branch ending with tip_hash
+
+        Only blocks after fork point are disconnected and connected.
+        """
+        tree = self.block_service.tree
+        fork = tree.find_fork(self.block_service.get_tip_hash(), tip_hash)
+        fork_hash = '' if fork is None else fork.hash
+        branch = tree.get_branch(fork_hash, tip_hash)
+        if any(node.invalid for node in branch):
+            raise ValidateError("Block on invalid branch")
+        print("REORGANIZE from", fork_hash, "to", tip_hash, len(branch), "blocks")
+        with self.block_service.db_service.batch():
+            while self.block_service.get_tip_hash() not in (fork_hash, None):
+                self.disconnect_block()
+            for node in branch:
+                try:
+                    self._connect_block(self.block_service.get_one(node.hash))
+                except ValidateError:
+                    for invalid in branch[branch.index(node):]:
+                        tree.invalidate(invalid.hash)
+                    raise
+
+    def _check_block(self, block: Block):
+        """Checks of block without its parent, run before block is stored or kept in orphan pool"""
+        if not block.hash.startswith(BLOCK_HASH_PREFIX):
+            raise ValidateError("Block is not mined")
+        # Odd merkle node is paired with itself, so duplicated transactions keep hash of valid block
+        if len({tx.id for tx in block.transactions}) != len(block.transactions):
+            raise ValidateError("Duplicate transactions in block")
+        tree = self.block_service.tree
+        if tree.is_invalid(block.hash) or tree.is_invalid(block.previous_hash):
+            raise ValidateError("Block on invalid branch")
 
     def store_block(self, block: Block, validate_transactions: bool = True):
-        if validate_transactions and block.transactions:
-            self._validate_transactions(block.transactions)
-            
-        block_id = self.block_service.store(block)
-        if block_id is None:
-            raise ValidateError("Invalid block")
+        """Connect block to chain or store it on side branch
+
+        When side branch gets more work than chain, chain is switched to it.
+        Apply block atomically: on ValidateError no changes are left in database.
+        """
+        self._check_block(block)
+        tree = self.block_service.tree
+        tip = tree.get(self.block_service.get_tip_hash())
+        if tip is None or block.previous_hash == tip.hash:
+            return self._connect_block(block, validate_transactions)
+        if block.hash in tree:
+            raise ValidateError("Block already stored")
+
+        try:
+            with self.block_service.db_service.batch():
+                block_id = self.block_service.store_side(block)
+                if block_id is None:
+                    raise ValidateError("Unknown parent block")
+                node = tree.get(block.hash)
+                if node.invalid:
+                    raise ValidateError("Block on invalid branch")
+                if node.work > tip.work:
+                    self._reorganize(block.hash)
+        except ValidateError:
+            tree.remove(block.hash)
+            raise
         return block_id
 
-    def append_chain(self, blocks: list[Block]):
-        stored = []
-        iterator = self.iterate_blocks()
-        while len(stored) < len(blocks):
+    def process_block(self, block: Block) -> str | None:
+        """Store block received from network
+
+        Block with unknown parent is kept in orphan pool and is stored after its parent.
+        Return None if block became orphan.
+        """
+        self._check_block(block)
+        tree = self.block_service.tree
+        if block.previous_hash != '' and block.previous_hash not in tree:
+            if block.hash not in self.orphan_pool and self.orphan_pool.add(block):
+                print("ORPHAN", block.hash, "waits for", block.previous_hash)
+            return
+        block_id = self.store_block(block)
+        self._connect_orphans(block.hash)
+        return block_id
+
+    def _connect_orphans(self, parent_hash: str):
+        parents = [parent_hash]
+        while parents:
+            for orphan in self.orphan_pool.pop_children(parents.pop()):
+                try:
+                    self.store_block(orphan)
+                except ValidateError as e:
+                    print("Invalid orphan", orphan.hash, e)
+                    continue
+                parents.append(orphan.hash)
+
+    def _restore_transactions(self, txs: list[Transaction]):
+        """Return transactions, which are not in chain and are still valid, to pool"""
+        for tx in txs:
+            if self.block_service.get_transaction_location(tx.id) is not None:
+                continue
             try:
-                stored.append(next(iterator))
-            except StopIteration:
-                break
-        stored = [bl.hash for bl in stored]
+                self.store_transaction(tx)
+            except ValidateError:
+                pass
+
+    def disconnect_block(self) -> Block | None:
+        """Remove last block from chain and revert its changes of utxos
+
+        Transactions of block are returned to pool before pool transactions depending on them.
+        """
+        with self.block_service.db_service.batch():
+            block = self.block_service.get_last()
+            if block is None:
+                return
+            removed = self.tx_service.mempool.remove_related(block.transactions)
+            undo = self.block_service.get_undo(block.hash)
+            if undo is not None:
+                self.tx_service.utxo_set.undo(undo.spent, undo.created)
+            self.block_service.disconnect_tip()
+            self._restore_transactions(list(block.transactions) + removed)
+        return block
+
+    def append_chain(self, blocks: list[Block]):
+        """Store blocks from oldest to newest, already stored ones are skipped"""
         for block in blocks:
-            if block.hash in stored:
+            if block.hash in self.block_service.tree:
                 continue
             print("ADD NEW", block.hash)
-            self.store_block(block)
+            self.process_block(block)
 
     def generate_key(self, password: str):
         key = self.key_service.generate(password)
@@ -1,8 +1,21 @@
-from app.backend.database.models import Transaction
+from app.backend.database.models import Transaction, UTXO
 from dataclasses import dataclass
+from functools import lru_cache
 from enum import Enum
 from hashlib import sha256
 from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey
+import threading
+import os
+
+SCRIPT_CACHE_SIZE = int(os.getenv('SCRIPT_CACHE_SIZE', '4096'))  # Compiled scripts kept in memory
+# Budget of input script, which is unlock script followed by lock script
+SCRIPT_MAX_LENGTH = int(os.getenv('SCRIPT_MAX_LENGTH', '10000'))
+SCRIPT_MAX_OPS = int(os.getenv('SCRIPT_MAX_OPS', '200'))
+SCRIPT_MAX_PUSH_SIZE = int(os.getenv('SCRIPT_MAX_PUSH_SIZE', '520'))
+SCRIPT_MAX_STACK_DEPTH = int(os.getenv('SCRIPT_MAX_STACK_DEPTH', '100'))
+# Budget of all input scripts of transaction
+TX_MAX_SCRIPT_LENGTH = int(os.getenv('TX_MAX_SCRIPT_LENGTH', '100000'))
+TX_MAX_SCRIPT_OPS = int(os.getenv('TX_MAX_SCRIPT_OPS', '2000'))
 
 
 class Operation(Enum):
@@ -24,14 +37,14 @@ class Operation(Enum):
         """Get operands size
         Positive - from script
         Negative - from stack or altstack. -1 = top element from stack, -2 from altstack
-        String - from transaction
+        String - signed message of referenced transaction
         """
         if self == Operation.push:
             return [8, int.from_bytes(next_bytes[:8], 'big')]
         if self == Operation.push_alt:
             return [-2]
         if self == Operation.verify_signature:
-            return [-1, -1, 'encode']
+            return [-1, -1, 'message']
         if self == Operation.check_equal:
             return [-1, -1]
         return []
@@ -47,36 +60,205 @@ class ScriptError(Exception):
     pass
 
 
+class ScriptBudgetError(ScriptError):
+    pass
+
+
+def _push(stack: list, altstack: list, operand: bytes, message: bytes):
+    stack.append(operand)
+
+
+def _push_alt(stack: list, altstack: list, operand: bytes, message: bytes):
+    stack.append(altstack.pop())
+
+
+def _verify_signature(stack: list, altstack: list, operand: bytes, message: bytes):
+    pubkey = Ed25519PublicKey.from_public_bytes(stack.pop())
+    pubkey.verify(stack.pop(), message)
+    stack.append(True)
+
+
+def _check_equal(stack: list, altstack: list, operand: bytes, message: bytes):
+    if not stack.pop() == stack.pop():
+        raise ScriptError("Equal error")
+
+
+def _hash_top(stack: list, altstack: list, operand: bytes, message: bytes):
+    stack.append(sha256(stack.pop()).digest())
+
+
+def _duplicate_top(stack: list, altstack: list, operand: bytes, message: bytes):
+    stack.append(stack[-1])
+
+
+_HANDLERS = [None] * 256  # Handler by opcode
+for _operation, _handler in (
+        (Operation.push, _push),
+        (Operation.push_alt, _push_alt),
+        (Operation.verify_signature, _verify_signature),
+        (Operation.check_equal, _check_equal),
+        (Operation.hash_top, _hash_top),
+        (Operation.duplicate_top, _duplicate_top),
+):
+    _HANDLERS[_operation.value[0]] = _handler
+
+_STACK_EFFECTS = {
+    _push: 1,
+    _push_alt: 1,
+    _verify_signature: -1,
+    _check_equal: -2,
+    _hash_top: 0,
+    _duplicate_top: 1
+}
+
+
+def _compile_script(script: bytes) -> tuple[tuple, bool]:
+    """Return program of (handler, push data) pairs and whether last push is complete
+
+    Push data of incomplete push is cut by end of script.
+    """
+    program = []
+    complete = True
+    i = 0
+    while i < len(script):
+        handler = _HANDLERS[script[i]]
+        if handler is None:
+            raise ScriptError(f"Invalid operation {script[i:i + 1]}")
+        i += 1
+        operand = None
+        if handler is _push:
+            size = int.from_bytes(script[i:i + 8], 'big')
+            operand = script[i + 8:i + 8 + size]
+            complete = i + 8 + size <= len(script)
+            i += 8 + size
+        program.append((handler, operand))
+    return tuple(program), complete
+
+
+compile_script = lru_cache(maxsize=SCRIPT_CACHE_SIZE)(_compile_script)
+
+
+def get_pushes(script: bytes) -> list[bytes] | None:
+    """Data of script made only of complete pushes, None for other scripts"""
+    pushes = []
+    i = 0
+    while i < len(script):
+        if script[i] != Operation.push.value[0] or i + 9 > len(script):
+            return
+        size = int.from_bytes(script[i + 1:i + 9], 'big')
+        if i + 9 + size > len(script):
+            return
+        pushes.append(script[i + 9:i + 9 + size])
+        i += 9 + size
+    return pushes
+
+
 class ScriptService:
-    def __init__(self, script: str, transaction: Transaction, altstack: list = None):
+    def __init__(self, script: str, message: bytes, altstack: list = None, lock_script: bytes = b''):
         """
         script: str - hex present of script
+        message: bytes - signed message of transaction which output is spent
+        lock_script: bytes - script run after script, compiled apart as it is shared by many inputs
         """
         self._stack = []  # Runtime memory
         self._altstack = [] if altstack is None else altstack  # Arguments for script
         # Altstack is being formed from outputs of matched inputs
-        self.script = bytes.fromhex(script) if isinstance(script, str) else script
-        self.tx = transaction
+        self.unlock_script = bytes.fromhex(script) if isinstance(script, str) else script
+        self.lock_script = lock_script
+        self.script = self.unlock_script + lock_script
+        self.message = message
 
     @classmethod
-    def run_transaction(cls, transaction: Transaction, depends: dict[str, Transaction]) -> list[bool]:
+    def run_transaction(cls, transaction: Transaction, depends: dict[str, UTXO]) -> list[bool]:
+        """depends: UTXO by outpoint id for every input"""
         results: list[bool] = []
+        for unlock_script, lock_script, message, altstack in cls.get_transaction_checks(transaction, depends):
+            results.extend(cls(unlock_script, message, altstack, lock_script).run())
+        return results
+
+    @staticmethod
+    def get_transaction_checks(transaction: Transaction, depends: dict[str, UTXO]) -> list[tuple[bytes, bytes, bytes, list]]:
+        """Return (unlock script, lock script, message, altstack) of every input, they can be run independently
+
+        depends: UTXO by outpoint id for every input
+        """
         altstack: list[bytes] = []
         for inp in transaction.inputs:
-            refer_out = depends[inp.tx_id].outputs[inp.output_index]
+            refer_out = depends[UTXO.make_id(inp.tx_id, inp.output_index)].output
             altstack.append(refer_out.value)
+        checks = []
         for inp in transaction.inputs:
-            refer_out = depends[inp.tx_id].outputs[inp.output_index]
-            script = inp.unlock_script + refer_out.lock_script
-            result = cls(script, depends[inp.tx_id], altstack.copy()).run()
-            results.extend(result)
-        return results
+            utxo = depends[UTXO.make_id(inp.tx_id, inp.output_index)]
+            checks.append((inp.unlock_script, utxo.output.lock_script, utxo.tx_hash, altstack.copy()))
+        return checks
+
+    @staticmethod
+    def compile(unlock_script: bytes, lock_script: bytes = b'') -> tuple:
+        """Program of unlock script followed by lock script
+
+        Lock scripts are shared by many inputs, so they are cached. Unlock scripts hold
+        signatures and are unique, caching them would only evict lock scripts.
+        """
+        program, complete = _compile_script(unlock_script)
+        if not lock_script:
+            return program
+        if not complete:  # Push of unlock script takes bytes of lock script
+            return _compile_script(unlock_script + lock_script)[0]
+        return program + compile_script(lock_script)[0]
+
+    @staticmethod
+    def make_address_lock_script(address: bytes) -> bytes:
+        """Pay-to-address script: spender shows public key hashed to address and its signature"""
+        script = Operation.duplicate_top.value
+        script += Operation.hash_top.value
+        script += Operation.push.value + len(address).to_bytes(8) + address
+        script += Operation.check_equal.value
+        script += Operation.verify_signature.value
+        return script
+
+    @staticmethod
+    def get_lock_script_address(script: bytes) -> bytes | None:
+        """Return receiver address if script is pay-to-address script"""
+        prefix = Operation.duplicate_top.value + Operation.hash_top.value + Operation.push.value
+        suffix = Operation.check_equal.value + Operation.verify_signature.value
+        if not script.startswith(prefix) or not script.endswith(suffix):
+            return
+        address = script[len(prefix) + 8:-len(suffix)]
+        if int.from_bytes(script[len(prefix):len(prefix) + 8]) != len(address):
+            return
+        return address
+
+    @staticmethod
+    def get_lock_script_value(script: bytes) -> bytes | None:
+        """Return value if script is value script: first referenced output of spender has the value
+
+        Object position scripts are value scripts.
+        """
+        suffix = Operation.push_alt.value + Operation.check_equal.value
+        if not script.endswith(suffix):
+            return
+        pushes = get_pushes(script[:-len(suffix)])
+        if pushes is None or len(pushes) != 1:
+            return
+        return pushes[0]
+
+    @staticmethod
+    @lru_cache(maxsize=SCRIPT_CACHE_SIZE)
+    def match_template(lock_script: bytes) -> tuple[str | None, bytes | None]:
+        """Return ('address', address), ('value', value) or (None, None) for other scripts"""
+        address = ScriptService.get_lock_script_address(lock_script)
+        if address is not None:
+            return 'address', address
+        value = ScriptService.get_lock_script_value(lock_script)
+        if value is not None:
+            return 'value', value
+        return None, None
 
     @classmethod
-    def get_transaction_depends(cls, transaction: Transaction) -> list[str]:
-        """Return list of transactions ids which transaction refer to"""
+    def get_transaction_depends(cls, transaction: Transaction) -> list[tuple[str, int]]:
+        """Return list of outpoints (tx_id, output_index) which transaction refer to"""
         return [
-            inp.tx_id
+            (inp.tx_id, inp.output_index)
             for inp in transaction.inputs
         ]
 
@@ -102,10 +284,7 @@ class ScriptService:
         operands = []
         for opsize in operation.operands_size(self.script[operands_index:]):
             if isinstance(opsize, str):
-                op = getattr(self.tx, opsize)
-                if callable(op):
-                    op = op()
-                operands.append(op)
+                operands.append(getattr(self, opsize))
             elif opsize >= 0:
                 operands.append(self.script[operands_index:operands_index + opsize])
                 operands_index += opsize
@@ -115,7 +294,8 @@ class ScriptService:
                 operands.append(self._altstack.pop(-1))
         return operands, operands_index - 1
 
-    def _run_script(self):
+    def _interpret_script(self):
+        """Decode and run script byte by byte, reference for compiled program"""
         i = -1
         while (i := i + 1) < len(self.script):
             operation = Operation.from_byte(self.script[i:i + 1])
@@ -124,17 +304,116 @@ class ScriptService:
             cmd = Command(operation=operation, operands=[])
             cmd.operands, i = self.get_command_operands(i + 1, operation)
             self.execute_command(cmd)
-            #print(f"Byte {i}:")
-            #print(f'\tCommand: {cmd}')
-            #print(f'\tStack: {self._stack}')
         if not self._stack:
             self._stack.append(True)
 
+    def _run_template(self) -> list | None:
+        """Run standard script without interpreter, None if script is not standard
+
+        Result and errors are the same as of interpreter.
+        """
+        template, data = self.match_template(self.lock_script)
+        if template == 'address':
+            address = data
+            pushes = get_pushes(self.unlock_script)
+            if pushes is None or len(pushes) != 2:
+                return
+            signature, public_key = pushes
+            if not sha256(public_key).digest() == address:
+                raise ScriptError("Equal error")
+            Ed25519PublicKey.from_public_bytes(public_key).verify(signature, self.message)
+            self._stack.append(True)
+            return self._stack
+        if template == 'value' and not self.unlock_script and self._altstack:
+            if not self._altstack.pop(-1) == data:
+                raise ScriptError("Equal error")
+            self._stack.append(True)
+            return self._stack
+
     def run(self):
-        self._run_script()
+        stack = self._run_template()
+        if stack is not None:
+            return stack
+        return self.run_compiled()
+
+    def run_compiled(self):
+        stack, altstack, message = self._stack, self._altstack, self.message
+        for handler, operand in self.compile(self.unlock_script, self.lock_script):
+            handler(stack, altstack, operand, message)
+        if not stack:
+            stack.append(True)
+        return stack
+
+    def run_interpreted(self):
+        self._interpret_script()
         return self._stack
 
 
+class ScriptBudget:
+    """Limits of script size and cost, checked before scripts are run
+
+    Script is rejected by length before it is compiled, by count of operations,
+    size of pushed data and depth of stack before signatures are verified.
+    Push data is cut by end of script, so declared push size never exceeds script length.
+    Rejections are counted by exceeded limit.
+    """
+
+    def __init__(
+            self,
+            max_length: int = SCRIPT_MAX_LENGTH,
+            max_ops: int = SCRIPT_MAX_OPS,
+            max_push_size: int = SCRIPT_MAX_PUSH_SIZE,
+            max_stack_depth: int = SCRIPT_MAX_STACK_DEPTH,
+            tx_max_length: int = TX_MAX_SCRIPT_LENGTH,
+            tx_max_ops: int = TX_MAX_SCRIPT_OPS
+    ):
+        self.max_length = max_length
+        self.max_ops = max_ops
+        self.max_push_size = max_push_size
+        self.max_stack_depth = max_stack_depth
+        self.tx_max_length = tx_max_length
+        self.tx_max_ops = tx_max_ops
+
+        self.rejected: dict[str, int] = {}  # Count of rejections by limit
+        self._lock = threading.Lock()
+
+    def _reject(self, limit: str, value: int):
+        with self._lock:
+            self.rejected[limit] = self.rejected.get(limit, 0) + 1
+        print("Script rejected by", limit, value)
+        raise ScriptBudgetError(f"Script exceeds {limit}: {value}")
+
+    def check_script(self, unlock_script: bytes, lock_script: bytes) -> tuple[int, int]:
+        """Return length and count of operations of input script"""
+        length = len(unlock_script) + len(lock_script)
+        if length > self.max_length:
+            self._reject('max_length', length)
+        program = ScriptService.compile(unlock_script, lock_script)
+        if len(program) > self.max_ops:
+            self._reject('max_ops', len(program))
+        depth = max_depth = 0
+        for handler, operand in program:
+            if operand is not None and len(operand) > self.max_push_size:
+                self._reject('max_push_size', len(operand))
+            depth += _STACK_EFFECTS[handler]
+            max_depth = max(depth, max_depth)
+        if max_depth > self.max_stack_depth:
+            self._reject('max_stack_depth', max_depth)
+        return length, len(program)
+
+    def check_transaction(self, checks: list[tuple[bytes, bytes, bytes, list]]):
+        """checks: from ScriptService.get_transaction_checks"""
+        length = ops = 0
+        for unlock_script, lock_script, _, _ in checks:
+            script_length, script_ops = self.check_script(unlock_script, lock_script)
+            length += script_length
+            ops += script_ops
+        if length > self.tx_max_length:
+            self._reject('tx_max_length', length)
+        if ops > self.tx_max_ops:
+            self._reject('tx_max_ops', ops)
+
+
 if __name__ == '__main__':
     script = b'\x00\x02\x1a\x01\x00\x02\xaa\xaa\x02'.hex()
     service = ScriptService(script, None)
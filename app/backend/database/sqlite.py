@@ -0,0 +1,141 @@
+from app.backend.database.models import StorableModel
+from app.backend.database.storage import StorageBackend
+import threading
+import sqlite3
+
+
+class SQLiteStorage(StorageBackend):
+    """Tables stored in SQLite database with WAL journal
+
+    Each table has `id` primary key, encoded model in `data` column
+    and indexed column for every attribute listed in model `__indexes__`.
+    """
+
+    def __init__(self, filename: str):
+        self.connection = sqlite3.connect(filename, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=FULL')
+        self._lock = threading.RLock()
+        self._columns: dict[str, tuple[str, ...]] = {}  # table -> indexed columns
+        self._savepoints = 0
+
+        tables = self.connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()
+        for (table_name,) in tables:
+            columns = self.connection.execute(f'PRAGMA table_info("{table_name}")').fetchall()
+            self._columns[table_name] = tuple(c[1] for c in columns if c[1] not in ('id', 'data'))
+            self._add_columns(table_name)
+
+    @staticmethod
+    def encode(model: StorableModel) -> bytes:
+        return model.dump()
+
+    @staticmethod
+    def decode(table_name, data: bytes) -> StorableModel:
+        return StorableModel.get_model(table_name).undump(data)
+
+    def _create_index(self, table_name, column):
+        self.connection.execute(f'CREATE INDEX IF NOT EXISTS "{table_name}_{column}" ON "{table_name}" ("{column}")')
+
+    def _create_table(self, table_name, model: StorableModel):
+        if table_name in self._columns:
+            return
+        columns = tuple(getattr(model, '__indexes__', ()))
+        definition = ''.join(f', "{column}"' for column in columns)
+        self.connection.execute(f'CREATE TABLE IF NOT EXISTS "{table_name}" (id PRIMARY KEY, data BLOB{definition})')
+        for column in columns:
+            self._create_index(table_name, column)
+        self._columns[table_name] = columns
+
+    def _add_columns(self, table_name):
+        """Add and fill columns for indexes declared after table was created"""
+        model = StorableModel.get_model(table_name)
+        missing = [column for column in model.__indexes__ if column not in self._columns[table_name]]
+        if not missing:
+            return
+        rows = self.connection.execute(f'SELECT id, data FROM "{table_name}"').fetchall()
+        self.connection.execute('BEGIN')
+        for column in missing:
+            self.connection.execute(f'ALTER TABLE "{table_name}" ADD COLUMN "{column}"')
+            self._create_index(table_name, column)
+        for model_id, data in rows:
+            row = self.decode(table_name, data)
+            self.connection.execute(
+                f'UPDATE "{table_name}" SET ' + ', '.join(f'"{column}" = ?' for column in missing) + ' WHERE id = ?',
+                (*[getattr(row, column, None) for column in missing], model_id)
+            )
+        self.connection.execute('COMMIT')
+        self._columns[table_name] += tuple(missing)
+
+    def next_id(self, table_name) -> int:
+        if table_name not in self._columns:
+            return 1
+        with self._lock:
+            (max_id,) = self.connection.execute(f'SELECT MAX(id) FROM "{table_name}"').fetchone()
+        return (max_id or 0) + 1
+
+    def save(self, table_name, model_id, model: StorableModel):
+        with self._lock:
+            self._create_table(table_name, model)
+            columns = self._columns[table_name]
+            names = ''.join(f', "{column}"' for column in columns)
+            self.connection.execute(
+                f'INSERT OR REPLACE INTO "{table_name}" (id, data{names}) VALUES (?, ?{", ?" * len(columns)})',
+                (model_id, self.encode(model), *[getattr(model, c, None) for c in columns])
+            )
+
+    def get(self, table_name, model_id) -> StorableModel | None:
+        if table_name not in self._columns:
+            return
+        with self._lock:
+            row = self.connection.execute(f'SELECT data FROM "{table_name}" WHERE id = ?', (model_id,)).fetchone()
+        return None if row is None else self.decode(table_name, row[0])
+
+    def delete(self, table_name, model_id) -> StorableModel | None:
+        with self._lock:
+            model = self.get(table_name, model_id)
+            if model is not None:
+                self.connection.execute(f'DELETE FROM "{table_name}" WHERE id = ?', (model_id,))
+        return model
+
+    def find(self, table_name, filters: dict) -> list[StorableModel]:
+        if table_name not in self._columns:
+            return []
+        conditions = [name for name in filters if name == 'id' or name in self._columns[table_name]]
+        query = f'SELECT data FROM "{table_name}"'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(f'"{name}" = ?' for name in conditions)
+        with self._lock:
+            rows = self.connection.execute(query, [filters[name] for name in conditions]).fetchall()
+        return [self.decode(table_name, data) for (data,) in rows]
+
+    def begin(self):
+        self._lock.acquire()
+        self.connection.execute('BEGIN')
+
+    def commit(self):
+        try:
+            self.connection.execute('COMMIT')
+        finally:
+            self._lock.release()
+
+    def rollback(self):
+        try:
+            self.connection.execute('ROLLBACK')
+        finally:
+            self._lock.release()
+
+    def savepoint(self):
+        self._savepoints += 1
+        name = f'sp{self._savepoints}'
+        self.connection.execute(f'SAVEPOINT {name}')
+        return name
+
+    def rollback_to(self, savepoint):
+        self.connection.execute(f'ROLLBACK TO {savepoint}')
+        self.connection.execute(f'RELEASE {savepoint}')
+
+    def release(self, savepoint):
+        self.connection.execute(f'RELEASE {savepoint}')
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,334 @@
+from app.backend.database.models import StorableModel
+import threading
+import struct
+import zlib
+import os
+
+DB_COMPACT_MIN_RECORDS = int(os.getenv('DB_COMPACT_MIN_RECORDS', '1000'))
+DB_COMPACT_RATIO = int(os.getenv('DB_COMPACT_RATIO', '4'))
+
+LOG_MAGIC = b'DBLOG\x01'
+_RECORD_HEADER = '>II'  # Body size, body crc32
+_OPERATIONS = {'save': 0, 'delete': 1}
+
+_MISSING = object()
+
+
+def _pack_record(operation: str, table_name: str, model_id, model: StorableModel | None) -> bytes:
+    table_name = table_name.encode()
+    if isinstance(model_id, int):
+        packed_id = struct.pack('>cq', b'i', model_id)
+    else:
+        packed_id = struct.pack(f'>cH{len(model_id.encode())}s', b's', len(model_id.encode()), model_id.encode())
+    body = struct.pack(f'>BB{len(table_name)}s', _OPERATIONS[operation], len(table_name), table_name) + packed_id
+    if model is not None:
+        body += model.dump()
+    return struct.pack(_RECORD_HEADER, len(body), zlib.crc32(body)) + body
+
+
+def _unpack_record(body: bytes) -> tuple:
+    operation, table_name_size = struct.unpack_from('>BB', body)
+    offset = 2 + table_name_size
+    table_name = body[2:offset].decode()
+    id_type = body[offset:offset + 1]
+    if id_type == b'i':
+        (model_id,) = struct.unpack_from('>q', body, offset + 1)
+        offset += 9
+    else:
+        (id_size,) = struct.unpack_from('>H', body, offset + 1)
+        model_id = body[offset + 3:offset + 3 + id_size].decode()
+        offset += 3 + id_size
+    operation = 'save' if operation == _OPERATIONS['save'] else 'delete'
+    model = None
+    if operation == 'save':
+        model = StorableModel.get_model(table_name).undump(body[offset:])
+    return operation, table_name, model_id, model
+
+
+class StorageBackend:
+    """Storage of DatabaseService tables
+
+    Transactions are opened by `begin` and finished by `commit` or `rollback`.
+    Savepoints are used for nested DatabaseService batches.
+    """
+
+    def next_id(self, table_name) -> int:
+        raise NotImplementedError
+
+    def save(self, table_name, model_id, model: StorableModel):
+        raise NotImplementedError
+
+    def get(self, table_name, model_id) -> StorableModel | None:
+        raise NotImplementedError
+
+    def delete(self, table_name, model_id) -> StorableModel | None:
+        raise NotImplementedError
+
+    def find(self, table_name, filters: dict) -> list[StorableModel]:
+        """Return rows narrowed by primary key or indexed filters. Other filters may be ignored"""
+        raise NotImplementedError
+
+    def begin(self):
+        raise NotImplementedError
+
+    def commit(self):
+        raise NotImplementedError
+
+    def rollback(self):
+        raise NotImplementedError
+
+    def savepoint(self):
+        raise NotImplementedError
+
+    def rollback_to(self, savepoint):
+        raise NotImplementedError
+
+    def release(self, savepoint):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+
+class LogStorage(StorageBackend):
+    """In-memory tables persisted to an append-only log
+
+    Every save and delete appends one checksummed record (operation, table, id,
+    binary dump of model) to the log. On startup the log is replayed to rebuild tables. When the log
+    grows far beyond the number of live rows it is compacted in background.
+
+    Attributes listed in model `__indexes__` are kept in hash indexes.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.tables = {}
+        self._indexes: dict[str, dict[str, dict]] = {}  # table -> attribute -> value -> ids
+        self._lock = threading.RLock()
+        self._log_records = 0
+        self._compacting = False
+        self._compact_thread = None
+        self._batch_records = None
+        self._batch_undo = None
+        if self._replay():
+            # Hashes of blocks and transactions have changed, so chain is synced again
+            os.replace(self.filename, self.filename + '.bak')
+            print("Database of older version is moved to", self.filename + '.bak')
+        self._log = open(self.filename, 'ab')
+        if self._log.tell() == 0:
+            self._log.write(LOG_MAGIC)
+            self._log.flush()
+
+    def _register_indexes(self, table_name, model):
+        if table_name in self._indexes:
+            return
+        self._indexes[table_name] = {attr: {} for attr in getattr(model, '__indexes__', ())}
+        for model_id, row in self.tables.get(table_name, {}).items():
+            self._index_row(table_name, model_id, row)
+
+    def _index_row(self, table_name, model_id, model):
+        for attr, index in self._indexes.get(table_name, {}).items():
+            index.setdefault(getattr(model, attr, None), {})[model_id] = None
+
+    def _unindex_row(self, table_name, model_id, model):
+        for attr, index in self._indexes.get(table_name, {}).items():
+            value = getattr(model, attr, None)
+            ids = index.get(value, {})
+            ids.pop(model_id, None)
+            if not ids:
+                index.pop(value, None)
+
+    def _set_row(self, table_name, model_id, model):
+        self._register_indexes(table_name, model)
+        rows = self.tables.setdefault(table_name, {})
+        if model_id in rows:
+            self._unindex_row(table_name, model_id, rows[model_id])
+        rows[model_id] = model
+        self._index_row(table_name, model_id, model)
+
+    def _pop_row(self, table_name, model_id):
+        """Raise KeyError if no row found"""
+        model = self.tables.get(table_name, {}).pop(model_id)
+        self._unindex_row(table_name, model_id, model)
+        return model
+
+    def _apply_record(self, record):
+        operation, table_name, model_id, model = record
+        if operation == 'save':
+            self._set_row(table_name, model_id, model)
+        elif operation == 'delete':
+            try:
+                self._pop_row(table_name, model_id)
+            except KeyError:
+                pass
+
+    def _replay(self) -> bool:
+        """Return True if database was stored in old pickle format, it is not loaded"""
+        try:
+            with open(self.filename, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return False
+        if data and not data.startswith(LOG_MAGIC):
+            return True
+
+        header_size = struct.calcsize(_RECORD_HEADER)
+        offset = valid_size = len(LOG_MAGIC)
+        while offset + header_size <= len(data):
+            body_size, checksum = struct.unpack_from(_RECORD_HEADER, data, offset)
+            body = data[offset + header_size:offset + header_size + body_size]
+            if len(body) < body_size or zlib.crc32(body) != checksum:
+                break
+            self._apply_record(_unpack_record(body))
+            self._log_records += 1
+            offset = valid_size = offset + header_size + body_size
+        if data and valid_size < len(data):
+            print("Truncated database log at", valid_size)
+            os.truncate(self.filename, valid_size)
+        return False
+
+    def _write_records(self, records: list):
+        if self._batch_records is not None:
+            self._batch_records.extend(records)
+            return
+        data = b''.join(_pack_record(*record) for record in records)
+        with self._lock:
+            self._log.write(data)
+            self._log.flush()
+            os.fsync(self._log.fileno())
+            self._log_records += len(records)
+        self._maybe_compact()
+
+    def _maybe_compact(self):
+        with self._lock:
+            live_records = sum(len(rows) for rows in self.tables.values())
+            if self._compacting or self._log_records < DB_COMPACT_MIN_RECORDS:
+                return
+            if self._log_records < live_records * DB_COMPACT_RATIO:
+                return
+            self._compacting = True
+        self._compact_thread = threading.Thread(target=self._compact, daemon=True)
+        self._compact_thread.start()
+
+    def _dump_tables(self, f, tables: dict) -> int:
+        """Write log with given rows, return count of records"""
+        records = 0
+        f.write(LOG_MAGIC)
+        for table_name, rows in tables.items():
+            for model_id, model in rows.items():
+                f.write(_pack_record('save', table_name, model_id, model))
+                records += 1
+        return records
+
+    def _compact(self):
+        """Rewrite log with only live rows. Records appended meanwhile are copied from log tail"""
+        tmp_filename = self.filename + '.compact'
+        try:
+            with self._lock:
+                self._log.flush()
+                snapshot_offset = self._log.tell()
+                snapshot_records = self._log_records
+                tables = {name: dict(rows) for name, rows in self.tables.items()}
+            with open(tmp_filename, 'wb') as tmp:
+                records = self._dump_tables(tmp, tables)
+                with self._lock:
+                    self._log.flush()
+                    with open(self.filename, 'rb') as f:
+                        f.seek(snapshot_offset)
+                        tail = f.read()
+                    tmp.write(tail)
+                    tmp.flush()
+                    os.fsync(tmp.fileno())
+                    self._log.close()
+                    os.replace(tmp_filename, self.filename)
+                    self._log = open(self.filename, 'ab')
+                    self._log_records = records + self._log_records - snapshot_records
+        finally:
+            self._compacting = False
+
+    def _remember(self, table_name, model_id):
+        if self._batch_undo is not None:
+            previous = self.tables.get(table_name, {}).get(model_id, _MISSING)
+            self._batch_undo.append((table_name, model_id, previous))
+
+    def begin(self):
+        self._lock.acquire()  # Compaction must not snapshot uncommitted rows
+        self._batch_records = []
+        self._batch_undo = []
+
+    def commit(self):
+        records = self._batch_records
+        self._batch_records = None
+        self._batch_undo = None
+        try:
+            if records:
+                self._write_records(records)
+        finally:
+            self._lock.release()
+
+    def rollback(self):
+        self.rollback_to((0, 0))
+        self._batch_records = None
+        self._batch_undo = None
+        self._lock.release()
+
+    def savepoint(self):
+        return len(self._batch_records), len(self._batch_undo)
+
+    def rollback_to(self, savepoint):
+        records_savepoint, undo_savepoint = savepoint
+        del self._batch_records[records_savepoint:]
+        while len(self._batch_undo) > undo_savepoint:
+            table_name, model_id, model = self._batch_undo.pop()
+            if model is not _MISSING:
+                self._set_row(table_name, model_id, model)
+                continue
+            try:
+                self._pop_row(table_name, model_id)
+            except KeyError:
+                pass
+
+    def release(self, savepoint):
+        pass
+
+    def close(self):
+        if self._compact_thread is not None:
+            self._compact_thread.join()
+        self._log.close()
+
+    def next_id(self, table_name) -> int:
+        return max(self.tables.get(table_name, {}).keys(), default=0) + 1
+
+    def save(self, table_name, model_id, model: StorableModel):
+        with self._lock:  # Row and its record must not be split by compaction snapshot
+            self._remember(table_name, model_id)
+            self._set_row(table_name, model_id, model)
+            self._write_records([('save', table_name, model_id, model)])
+
+    def get(self, table_name, model_id) -> StorableModel | None:
+        return self.tables.get(table_name, {}).get(model_id)
+
+    def delete(self, table_name, model_id) -> StorableModel | None:
+        with self._lock:
+            self._remember(table_name, model_id)
+            try:
+                ret = self._pop_row(table_name, model_id)
+            except KeyError:
+                return
+            self._write_records([('delete', table_name, model_id, None)])
+        return ret
+
+    def find(self, table_name, filters: dict) -> list[StorableModel]:
+        with self._lock:
+            rows = self.tables.get(table_name, {})
+            if 'id' in filters:
+                model = rows.get(filters['id'])
+                return [] if model is None else [model]
+            indexes = self._indexes.get(table_name, {})
+            ids = None
+            for attr in [attr for attr in filters if attr in indexes]:
+                attr_ids = indexes[attr].get(filters[attr], {})
+                ids = attr_ids.keys() if ids is None else [i for i in ids if i in attr_ids]
+            if ids is None:
+                return list(rows.values())
+            return [rows[i] for i in ids]
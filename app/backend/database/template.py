@@ -0,0 +1,103 @@
+from app.backend.database.models import Block, Transaction
+from hashlib import sha256
+import datetime as dt
+import threading
+import os
+
+BLOCK_MAX_TRANSACTIONS = int(os.getenv('BLOCK_MAX_TRANSACTIONS', '1000'))
+
+
+class MerkleTree:
+    """Levels of merkle tree, root is updated in O(log n) when leaf is appended
+
+    Odd node is paired with itself, as in `models.merkle_root`.
+    """
+
+    def __init__(self, leaves: list[bytes] = ()):
+        self._levels: list[list[bytes]] = [[]]
+        for leaf in leaves:
+            self.append(leaf)
+
+    def __len__(self) -> int:
+        return len(self._levels[0])
+
+    @property
+    def root(self) -> bytes:
+        if not self._levels[0]:
+            return b'\x00' * 32
+        return self._levels[-1][0]
+
+    def append(self, leaf: bytes):
+        self._levels[0].append(leaf)
+        index, level = len(self._levels[0]) - 1, 0
+        while len(self._levels[level]) > 1:  # Update path from leaf to root
+            nodes = self._levels[level]
+            pair = index - index % 2
+            right = nodes[pair + 1] if pair + 1 < len(nodes) else nodes[pair]
+            parent = sha256(sha256(nodes[pair] + right).digest()).digest()
+            if level + 1 == len(self._levels):
+                self._levels.append([])
+            upper = self._levels[level + 1]
+            index //= 2
+            if index < len(upper):
+                upper[index] = parent
+            else:
+                upper.append(parent)
+            level += 1
+
+
+class BlockTemplate:
+    """Candidate block of oldest mempool transactions, ready to be mined
+
+    Template follows mempool: added transactions are appended with merkle root updated
+    in O(log n), removal of included ones rebuilds it. Previous hash is taken from tip
+    when block is requested, so new tip needs no rebuild.
+    """
+
+    def __init__(self, block_service, mempool, max_txs: int = BLOCK_MAX_TRANSACTIONS):
+        self.block_service = block_service
+        self.mempool = mempool
+        self.max_txs = max_txs
+
+        self._txs: list[Transaction] = []
+        self._ids: set[str] = set()
+        self._tree = MerkleTree()
+        self._lock = threading.Lock()
+        self.pool_reloaded()
+        self.mempool.add_listener(self)
+
+    def _rebuild(self):
+        self._txs = self.mempool.select(self.max_txs)
+        self._ids = {tx.id for tx in self._txs}
+        self._tree = MerkleTree([bytes.fromhex(tx.id) for tx in self._txs])
+
+    def tx_added(self, tx: Transaction):
+        with self._lock:
+            if len(self._txs) >= self.max_txs:
+                return
+            self._txs.append(tx)
+            self._ids.add(tx.id)
+            self._tree.append(bytes.fromhex(tx.id))
+
+    def txs_removed(self, txs: list[Transaction]):
+        with self._lock:
+            if any(tx.id in self._ids for tx in txs):
+                self._rebuild()
+
+    def pool_reloaded(self):
+        with self._lock:
+            self._rebuild()
+
+    def get(self) -> Block:
+        """New block on current tip, merkle root is already computed"""
+        with self._lock:
+            transactions = list(self._txs)
+            root = self._tree.root
+        block = Block(
+            transactions=transactions,
+            previous_hash=self.block_service.get_tip_hash() or '',
+            timestamp=dt.datetime.now(dt.UTC),
+            nounce=0
+        )
+        block.merkle_root = root
+        return block
@@ -1,10 +1,10 @@
 from app.backend.database.models import Transaction
-from app.backend.database.models import UTXOs
+from app.backend.database.models import UTXO, TransactionUndo
 from app.backend.database.models import TXInput, TXOutput
 from app.backend.database.models import ValidateError
 from app.backend.database.models import Key
 
-from app.backend.database.script import ScriptService, Operation
+from app.backend.database.script import ScriptService, ScriptError, Operation
 from app.backend.database.key import KeyService
 
 from enum import Enum
@@ -20,75 +20,45 @@ def hash_string(string: str) -> bytes:
 class TransactionService:
     """Implements transaction pool and validator"""
 
-    def __init__(self, db_service):
+    def __init__(self, db_service, block_service, utxo_set, mempool, validation_service):
         self.db_service = db_service
+        self.block_service = block_service
+        self.utxo_set = utxo_set
+        self.mempool = mempool
+        self.validation_service = validation_service
 
     def get_utxos(
             self,
             transaction_id: str = None,
             output_index: int = None,
             output_lock_script_part: bytes = None,
-            output_value: bytes = None
-    ) -> list[UTXOs]:
+            output_value: bytes = None,
+            address: bytes = None
+    ) -> list[UTXO]:
         """
         :param output_lock_script_part: Check if part in output.lock_script
+        :param address: Receiver address of pay-to-address output, looked up by index
         """
-        filters = {'transaction_id': transaction_id} if transaction_id is not None else {}
-        utxos_list = self.db_service.find('utxos', **filters)
+        if transaction_id is not None and output_index is not None:
+            utxo = self.utxo_set.lookup(transaction_id, output_index)
+            utxos_list = [] if utxo is None else [utxo]
+        else:
+            filters = {'tx_id': transaction_id} if transaction_id is not None else {}
+            if address is not None:
+                filters['address'] = address
+            utxos_list = self.utxo_set.find(**filters)
         if output_index is not None:
-            utxos_list = filter(lambda i: output_index in i.outputs_indexes, utxos_list)
+            utxos_list = filter(lambda i: i.output_index == output_index, utxos_list)
         if output_lock_script_part is not None:
-            utxos_list = filter(
-                lambda i: any(output_lock_script_part in out.lock_script for out in i.transaction.outputs),
-                utxos_list
-            )
+            utxos_list = filter(lambda i: output_lock_script_part in i.output.lock_script, utxos_list)
         if output_value is not None:
-            utxos_list = filter(
-                lambda i: any(output_value == out.value for out in i.transaction.outputs),
-                utxos_list
-            )
+            utxos_list = filter(lambda i: output_value == i.output.value, utxos_list)
         return list(utxos_list)
 
-    def create_utxos(self, tx: Transaction):
-        """Create and save new utxos and remove input utxos"""
-        utxos = UTXOs(
-            transaction_id=tx.id,
-            outputs_indexes=[i for i in range(len(tx.outputs))],
-            transaction=tx
-        )
-        self.db_service.save(utxos)
-        for inp in tx.inputs:
-            utxos_list = self.get_utxos(transaction_id=inp.tx_id)
-            if not utxos:
-                continue
-            for utxos in utxos_list:
-                if inp.output_index not in utxos.outputs_indexes:
-                    print("!@#!@#!@#$")
-                    continue
-                utxos.outputs_indexes.remove(inp.output_index)
-                if not utxos.outputs_indexes:
-                    self.db_service.delete('utxos', utxos.id)
-                else:
-                    self.db_service.update(utxos.id, utxos)
-        return utxos
-
-    def delete_utxos(self, tx: Transaction):
-        """Delete utxos"""
-        utxos_list = self.get_utxos(tx.id)
-        if utxos_list:
-            for utxos in utxos_list:
-                self.db_service.delete('utxos', utxos.id)
-        for inp in tx.inputs:
-            input_tx_block = self.db_service.find('block', subfilters={'transactions': {'id': inp.tx_id}})
-            if not input_tx_block:
-                continue
-            input_tx = [tx for tx in input_tx_block[0].transactions if tx.id == inp.tx_id][0]
-            utxos = UTXOs(
-                transaction_id=input_tx.id,
-                outputs_indexes=[inp.output_index],
-                transaction=input_tx
-            )
-            self.db_service.save(utxos)
+    def create_utxos(self, tx: Transaction) -> TransactionUndo:
+        """Spend input utxos and add outputs of transaction. Return changes to undo it"""
+        spent, created = self.utxo_set.apply([tx])
+        return TransactionUndo(id=tx.id, spent=spent, created=created)
 
     def make(
             self,
@@ -108,11 +78,10 @@ class TransactionService:
     ) -> TXInput:
         """By default unlock script is tx signature + public key"""
         if unlock_script is None:
-            utxos = self.get_utxos(transaction_id=tx_id)
-            if not utxos:
+            utxo = self.utxo_set.lookup(tx_id, output_index)
+            if utxo is None:
                 raise ValueError("No available utxos found for new input")
-            utxos = utxos[0]
-            signature = key.private_key.sign(utxos.transaction.encode())
+            signature = key.private_key.sign(utxo.tx_hash)
             raw_public_key = key.public_key.public_bytes_raw()
             unlock_script = Operation.push.value + len(signature).to_bytes(8) + signature
             unlock_script += Operation.push.value + len(raw_public_key).to_bytes(8) + raw_public_key
@@ -131,43 +100,107 @@ class TransactionService:
     ) -> TXOutput:
         """By default lock script is address of receiver"""
         if lock_script is None:
-            lock_script = Operation.duplicate_top.value
-            lock_script += Operation.hash_top.value
-            lock_script += Operation.push.value + len(receiver_address).to_bytes(8) + receiver_address
-            lock_script += Operation.check_equal.value
-            lock_script += Operation.verify_signature.value
+            lock_script = ScriptService.make_address_lock_script(receiver_address)
         return TXOutput(
             input_index=input_index,
             value=value,
             lock_script=lock_script
         )
 
-    def validate(self, tx: Transaction) -> bool:
+    def get_depends(self, tx: Transaction, created: dict[str, UTXO] = None, lookup=None) -> dict[str, UTXO] | None:
+        """Return utxos spent by transaction, None if some is not available
+
+        created: utxos by outpoint id, which are not applied to utxo set yet
+        lookup: finds unspent output by outpoint, utxo set lookup by default
+        """
+        lookup = self.utxo_set.lookup if lookup is None else lookup
         depends = {}
-        for depends_tx_id in ScriptService.get_transaction_depends(tx):
-            utxos = self.get_utxos(depends_tx_id)
-            if not utxos:
-                print("No available utxos found", depends_tx_id)
-                return False
-            utxos = utxos[0]
-            depends[depends_tx_id] = utxos.transaction
-        results = ScriptService.run_transaction(tx, depends)
-        return all(results)
-
-    def delete(self, transaction):
-        if self.db_service.delete('transaction', transaction.id) is not None:
-            self.delete_utxos(transaction)
+        for tx_id, output_index in ScriptService.get_transaction_depends(tx):
+            utxo = lookup(tx_id, output_index)
+            if utxo is None and created is not None:
+                utxo = created.get(UTXO.make_id(tx_id, output_index))
+            if utxo is None:
+                print("No available utxos found", tx_id, output_index)
+                return
+            depends[utxo.id] = utxo
+        return depends
+
+    def validate(self, tx: Transaction) -> bool:
+        """Verified inputs are cached, so block with transaction skips their signatures"""
+        depends = self.get_depends(tx)
+        if depends is None:
+            return False
+        try:
+            checks, keys = self.validation_service.get_checks(tx, depends)
+        except ScriptError:
+            return False
+        return self.validation_service.check([checks], [keys], store=True)[0]
+
+    def delete(self, transaction) -> list[Transaction]:
+        """Remove transaction from pool with its descendants"""
+        return self.mempool.remove([transaction.id])
+
+    def _check_pool(self, transaction: Transaction):
+        if transaction.id in self.mempool:
+            raise ValidateError("Transaction is already in pool")
+        if self.mempool.get_conflicts(transaction):
+            raise ValidateError("Transaction inputs are spent by pool transaction")
+
+    def _push(self, transaction: Transaction):
+        for tx in self.mempool.add(transaction):
+            print("Evicted from pool", tx.id)
 
     def store(self, transaction: Transaction):
-        if not self.validate(transaction):
-            raise ValidateError("Invalid transaction")
-        self.db_service.save(transaction)
+        """Validate transaction and push it to pool with its changes of utxos
+
+        Database lock is held from pool check to push, so conflicting transaction can't be pushed in between.
+        """
+        with self.db_service.batch():
+            self._check_pool(transaction)
+            if not self.validate(transaction):
+                raise ValidateError("Invalid transaction")
+            self._push(transaction)
+
+    def store_many(self, transactions: list[Transaction]) -> list[bool]:
+        """Validate scripts of transactions in parallel, then push valid ones to pool in order
+
+        Later transactions can spend outputs of earlier ones.
+        Return whether every transaction was pushed to pool.
+        """
+        created: dict[str, UTXO] = {}
+        groups, keys, depends_list = [], [], []
+        for tx in transactions:
+            checks, tx_keys = [], []
+            try:
+                self._check_pool(tx)
+                depends = self.get_depends(tx, created)
+                if depends is not None:
+                    checks, tx_keys = self.validation_service.get_checks(tx, depends)
+            except (ValidateError, ScriptError):
+                depends = None
+            depends_list.append(depends)
+            groups.append(checks)
+            keys.append(tx_keys)
+            for output_index in range(len(tx.outputs)):
+                utxo = UTXO.from_transaction(tx, output_index)
+                created[utxo.id] = utxo
+        results = self.validation_service.check(groups, keys, store=True)
+
+        stored = []
+        with self.db_service.batch():  # Pool could be changed by other thread while scripts were validated
+            for tx, depends, valid in zip(transactions, depends_list, results):
+                # Earlier transaction of list could be rejected or conflict with this one
+                available = depends is not None and all(
+                    self.utxo_set.lookup(utxo.tx_id, utxo.output_index) for utxo in depends.values()
+                )
+                if not valid or not available or tx.id in self.mempool or self.mempool.get_conflicts(tx):
+                    stored.append(False)
+                    continue
+                self._push(tx)
+                stored.append(True)
+        return stored
 
     def pop_all(self) -> list[Transaction]:
         """Clear pool and return cleared transactions"""
-        txs = self.db_service.find('transaction')
-        for tx in txs:
-            self.delete_utxos(tx)
-            self.db_service.delete('transaction', tx.id)
-        return txs
+        return self.mempool.clear()
 
@@ -0,0 +1,56 @@
+from app.backend.database.models import Transaction, UTXO, ValidateError
+
+
+class UTXOSet:
+    """Unspent outputs keyed by outpoint (tx_id, output_index)
+
+    Only output and signed message of its transaction are stored,
+    so add, spend and lookup are single operations by primary key.
+    """
+
+    def __init__(self, db_service):
+        self.db_service = db_service
+
+    def add(self, tx: Transaction) -> list[UTXO]:
+        """Add all outputs of transaction"""
+        added = [UTXO.from_transaction(tx, i) for i in range(len(tx.outputs))]
+        with self.db_service.batch():
+            for utxo in added:
+                self.db_service.save(utxo)
+        return added
+
+    def spend(self, tx_id: str, output_index: int) -> UTXO | None:
+        """Remove output, return it or None if it is not unspent"""
+        return self.db_service.delete(UTXO.table_name, UTXO.make_id(tx_id, output_index))
+
+    def lookup(self, tx_id: str, output_index: int) -> UTXO | None:
+        return self.db_service.get(UTXO.table_name, UTXO.make_id(tx_id, output_index))
+
+    def find(self, **filters) -> list[UTXO]:
+        return self.db_service.find(UTXO.table_name, **filters)
+
+    def apply(self, txs: list[Transaction]) -> tuple[list[UTXO], list[tuple[str, int]]]:
+        """Spend inputs and add outputs of transactions in order
+
+        Return spent outputs and created outpoints, which are needed to undo.
+        Raise ValidateError if some input has no unspent output, nothing is changed then.
+        """
+        spent, created = [], []
+        with self.db_service.batch():
+            for tx in txs:
+                for inp in tx.inputs:
+                    utxo = self.spend(inp.tx_id, inp.output_index)
+                    if utxo is None:
+                        raise ValidateError("Input spends missing or spent output")
+                    spent.append(utxo)
+                created.extend((utxo.tx_id, utxo.output_index) for utxo in self.add(tx))
+        return spent, created
+
+    def undo(self, spent: list[UTXO], created: list[tuple[str, int]]):
+        """Revert `apply` with changes it returned"""
+        with self.db_service.batch():
+            for utxo in spent:
+                self.db_service.save(utxo)
+            # After spent ones, so outputs created and spent by the same changes are removed too
+            for tx_id, output_index in created:
+                self.spend(tx_id, output_index)
@@ -0,0 +1,148 @@
+from app.backend.database.models import Transaction, UTXO
+from app.backend.database.script import ScriptService, ScriptBudget
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
+from hashlib import sha256
+import multiprocessing
+import threading
+import os
+
+VALIDATION_PROCESSES = int(os.getenv('VALIDATION_PROCESSES', str(os.cpu_count() or 1)))
+VALIDATION_MIN_PARALLEL = int(os.getenv('VALIDATION_MIN_PARALLEL', '32'))  # Fewer input checks run in calling thread
+SIGNATURE_CACHE_SIZE = int(os.getenv('SIGNATURE_CACHE_SIZE', '100000'))
+
+
+def run_checks(checks: list[tuple[bytes, bytes, bytes, list]]) -> bool:
+    """Run (unlock script, lock script, message, altstack) checks of transaction inputs, any error fails them"""
+    for unlock_script, lock_script, message, altstack in checks:
+        try:
+            if not all(ScriptService(unlock_script, message, altstack, lock_script).run()):
+                return False
+        except Exception:
+            return False
+    return True
+
+
+def _run_groups(groups: list[list[tuple]]) -> list[bool]:
+    return [run_checks(checks) for checks in groups]
+
+
+class SignatureCache:
+    """Inputs whose scripts were verified successfully, least recently used are evicted
+
+    Key is (tx id, input index, hash of lock script). Transaction id covers unlock scripts
+    and spent outpoints, so the same key always means the same check.
+    """
+
+    def __init__(self, max_size: int = SIGNATURE_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+        self._keys: OrderedDict[tuple[str, int, bytes], None] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_keys(transaction: Transaction, depends: dict[str, UTXO]) -> list[tuple[str, int, bytes]]:
+        """Keys of every input, in order of ScriptService.get_transaction_checks"""
+        keys = []
+        for input_index, inp in enumerate(transaction.inputs):
+            utxo = depends[UTXO.make_id(inp.tx_id, inp.output_index)]
+            keys.append((transaction.id, input_index, sha256(utxo.output.lock_script).digest()))
+        return keys
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, key: tuple[str, int, bytes]) -> bool:
+        with self._lock:
+            if key not in self._keys:
+                self.misses += 1
+                return False
+            self._keys.move_to_end(key)
+            self.hits += 1
+            return True
+
+    def add(self, keys: list[tuple[str, int, bytes]]):
+        with self._lock:
+            for key in keys:
+                self._keys[key] = None
+                self._keys.move_to_end(key)
+            while len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+
+
+class ValidationService:
+    """Script checks of transactions split between worker processes
+
+    Every input is checked against output it spends, so checks are independent
+    and utxo changes can be applied in order before or after them.
+    Script interpreter and signature verification hold GIL, so processes are used, not threads.
+    Workers are forked when service is created, so it must be created before other threads start.
+    """
+
+    def __init__(
+            self,
+            processes: int = VALIDATION_PROCESSES,
+            min_parallel: int = VALIDATION_MIN_PARALLEL,
+            cache_size: int = SIGNATURE_CACHE_SIZE
+    ):
+        self.processes = processes
+        self.min_parallel = min_parallel
+        self.cache = SignatureCache(cache_size)
+        self.budget = ScriptBudget()
+        # Workers must not re-run main module of node, which happens with spawn
+        start_method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn'
+        self._context = multiprocessing.get_context(start_method)
+        self._executor = None
+        if self.processes > 1:
+            self._executor = ProcessPoolExecutor(max_workers=self.processes, mp_context=self._context)
+            self._executor.submit(int).result()  # With fork all workers are started by first task
+
+    def get_checks(self, transaction: Transaction, depends: dict[str, UTXO]) -> tuple[list[tuple], list[tuple]]:
+        """Return script checks of transaction inputs and their cache keys
+
+        Raise ScriptError if scripts exceed budget, so no signature is verified for them.
+        """
+        checks = ScriptService.get_transaction_checks(transaction, depends)
+        self.budget.check_transaction(checks)
+        return checks, SignatureCache.make_keys(transaction, depends)
+
+    def check(self, groups: list[list[tuple]], keys: list[list[tuple]] = None, store: bool = False) -> list[bool]:
+        """Return result for every group of checks, e.g. for checks of every transaction
+
+        keys: SignatureCache keys of every check, checks found in cache are skipped
+        store: add keys of successful groups to cache
+        """
+        if keys is not None:
+            groups = [
+                [check for check, key in zip(checks, group_keys) if key not in self.cache]
+                for checks, group_keys in zip(groups, keys)
+            ]
+        results = self._check(groups)
+        if keys is not None and store:
+            for group_keys, valid in zip(keys, results):
+                if valid:
+                    self.cache.add(group_keys)
+        return results
+
+    def _check(self, groups: list[list[tuple]]) -> list[bool]:
+        count = sum(len(checks) for checks in groups)
+        if self.processes <= 1 or count < self.min_parallel:
+            return _run_groups(groups)
+        # Chunks of groups with about equal count of checks, a few per worker for balance
+        chunk_size = max(count // (self.processes * 4), 1)
+        chunks, chunk, chunk_count = [], [], 0
+        for checks in groups:
+            chunk.append(checks)
+            chunk_count += len(checks)
+            if chunk_count >= chunk_size:
+                chunks.append(chunk)
+                chunk, chunk_count = [], 0
+        if chunk:
+            chunks.append(chunk)
+        return [result for results in self._executor.map(_run_groups, chunks) for result in results]
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
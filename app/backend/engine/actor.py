@@ -1,5 +1,5 @@
 from app.backend.engine.models import Actor
-from app.backend.database.models import Transaction
+from app.backend.database.models import Transaction, UTXO, Key
 from uuid import UUID
 from enum import Enum
 
@@ -27,46 +27,36 @@ class ActorRepository:
                 raise ValueError("Invalid address or password")
         return Actor(id=key.hexaddress, token=key.token)
 
-    def get_actor_unspent_transactions(self, actor_id: str) -> list[tuple[Transaction, int]]:
-        txs = []
-        actor_id: bytes = bytes.fromhex(actor_id)
-        utxos_list = self.db_rep.find_utxos(output_lock_script_part=actor_id)
-        for utxos in utxos_list:
-            for out_index in utxos.outputs_indexes:
-                if actor_id in utxos.transaction.outputs[out_index].lock_script:
-                    txs.append((utxos.transaction, out_index))
-        return txs
+    def get_actor_unspent_outputs(self, actor_id: str) -> list[UTXO]:
+        return self.db_rep.find_utxos(address=Key.address_from_hex(actor_id))
 
     def get_actor_outputs(
             self,
             actor_id: str,
             movement: bool = False,
             pick: bool = False
-    ) -> list[tuple]:
-        """Return list of (Transaction, output)"""
+    ) -> list[UTXO]:
         outputs = []
-        txs = self.get_actor_unspent_transactions(actor_id)
-        for tx, out_index in txs:
-            out = tx.outputs[out_index]
-            if movement and b';' in out.value:
-                outputs.append((tx, out))
-            if pick and out.value.count(b'-') == 4:
-                outputs.append((tx, out))
+        for utxo in self.get_actor_unspent_outputs(actor_id):
+            if movement and b';' in utxo.output.value:
+                outputs.append(utxo)
+            if pick and utxo.output.value.count(b'-') == 4:
+                outputs.append(utxo)
         return outputs
 
     def make_move(self, actor_key, direction: MoveDirections) -> Transaction:
         tx_inputs = []
 
         actor_id = actor_key.hexaddress
-        curr_pos = self.get_position(actor_id)
-        new_pos = (curr_pos[0] + direction.value[0], curr_pos[1] + direction.value[1])
         move_outputs = self.get_actor_outputs(actor_id, movement=True)
-        
+        curr_pos = self._get_position_from_outputs(move_outputs)
+        new_pos = (curr_pos[0] + direction.value[0], curr_pos[1] + direction.value[1])
+
         if move_outputs:
-            move_tx, move_output = move_outputs[0]
+            move_utxo = move_outputs[0]
             tx_inputs.append(self.db_rep.make_transaction_input(
-                tx_id=move_tx.id,
-                output_index=move_tx.outputs.index(move_output),
+                tx_id=move_utxo.tx_id,
+                output_index=move_utxo.output_index,
                 key=actor_key
             ))
         tx_outputs = [
@@ -87,17 +77,18 @@ class ActorRepository:
 
     def get_many(self) -> list[Actor]:
         actors = set()
-        utxos_list = self.db_rep.find_utxos()
-        for utxos in utxos_list:
-            for out_index in utxos.outputs_indexes:
-                if b';' in utxos.transaction.outputs[out_index].value:
-                    actors.add(utxos.transaction.outputs[out_index].lock_script.hex()[22:-4])
+        for utxo in self.db_rep.find_utxos():
+            if b';' in utxo.output.value:
+                actors.add(utxo.output.lock_script.hex()[22:-4])
         return [Actor(id=i) for i in actors]
 
     def get_position(self, actor_id) -> tuple[int, int]:
-        move_outputs = self.get_actor_outputs(actor_id, movement=True)
+        return self._get_position_from_outputs(self.get_actor_outputs(actor_id, movement=True))
+
+    @staticmethod
+    def _get_position_from_outputs(move_outputs: list[UTXO]) -> tuple[int, int]:
         if move_outputs:
-            x, y = move_outputs[0][1].value.decode().split(';')
+            x, y = move_outputs[0].output.value.decode().split(';')
             return int(x), int(y)
         return 0, 0
 
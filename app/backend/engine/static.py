@@ -3,7 +3,7 @@ from uuid import uuid5, NAMESPACE_DNS, UUID
 
 from app.backend.engine.models import StaticObject
 from app.backend.engine.actor import MoveDirections
-from app.backend.database.models import Transaction
+from app.backend.database.models import Transaction, UTXO, Key
 from app.backend.database.script import Operation
 
 
@@ -22,6 +22,11 @@ class StaticObjectRepository:
         script += Operation.check_equal.value
         return script
 
+    def is_object_script(self, script: bytes) -> bool:
+        """Object which lock script is its position lies on the ground"""
+        return script.startswith(Operation.push.value) \
+            and script.endswith(Operation.push_alt.value + Operation.check_equal.value)
+
     def get_object_position_from_script(self, script: bytes) -> tuple[int, int]:
         pos_length = script[len(Operation.push.value):len(Operation.push.value) + 8]
         pos_length = int.from_bytes(pos_length)
@@ -40,50 +45,50 @@ class StaticObjectRepository:
         tx = self.db_rep.make_transaction(inputs=[], outputs=outputs)
         return tx
 
-    def find_object_transaction(self, object_id: str) -> Transaction | None:
-        for utxos in self.db_rep.find_utxos(output_value=object_id.encode()):
-            return utxos.transaction
+    def find_object_output(self, object_id: str) -> UTXO | None:
+        for utxo in self.db_rep.find_utxos(output_value=object_id.encode()):
+            return utxo
 
     def make_pick_transaction(self, object_id: str, actor_key):
-        object_tx = self.find_object_transaction(object_id)
-        actor_move_tx, actor_move_tx_out = self.actor_rep.get_actor_outputs(actor_key.hexaddress, movement=True)[0]
+        object_utxo = self.find_object_output(object_id)
+        actor_move_utxo = self.actor_rep.get_actor_outputs(actor_key.hexaddress, movement=True)[0]
         inputs = [
             self.db_rep.make_transaction_input(
-                tx_id=object_tx.id,
-                output_index=0,
+                tx_id=object_utxo.tx_id,
+                output_index=object_utxo.output_index,
                 unlock_script=b'',
                 key=actor_key
             ),
             self.db_rep.make_transaction_input(
-                tx_id=actor_move_tx.id,
-                output_index=actor_move_tx.outputs.index(actor_move_tx_out),
+                tx_id=actor_move_utxo.tx_id,
+                output_index=actor_move_utxo.output_index,
                 key=actor_key
             )
         ]
         outputs = [
             self.db_rep.make_transaction_output(
                 input_index=0,
-                value=object_tx.outputs[0].value,
+                value=object_utxo.output.value,
                 receiver_address=actor_key.address
             ),
             self.db_rep.make_transaction_output(
                 input_index=1,
-                value=actor_move_tx_out.value,
+                value=actor_move_utxo.output.value,
                 receiver_address=actor_key.address
             )
         ]
         return self.db_rep.make_transaction(inputs=inputs, outputs=outputs)
 
     def drop_object(self, object_id: str, actor_key):
-        object_tx = self.find_object_transaction(object_id)
-        if object_tx is None:
+        object_utxo = self.find_object_output(object_id)
+        if object_utxo is None:
             return
 
         actor_pos = self.actor_rep.get_position(actor_key.hexaddress)
         inputs = [
             self.db_rep.make_transaction_input(
-                tx_id=object_tx.id,
-                output_index=0,
+                tx_id=object_utxo.tx_id,
+                output_index=object_utxo.output_index,
                 key=actor_key
             )
         ]
@@ -128,15 +133,12 @@ class StaticObjectRepository:
 
     def get_actor_picked(self, actor_id: str) -> list[str]:
         picked = []
-        actor_id: bytes = bytes.fromhex(actor_id)
-        for utxos in self.db_rep.find_utxos(output_lock_script_part=actor_id):
-            for out_index in utxos.outputs_indexes:
-                out = utxos.transaction.outputs[out_index]
-                try:
-                    UUID(out.value.decode())
-                except ValueError:
-                    continue
-                picked.append(out.value.decode())
+        for utxo in self.db_rep.find_utxos(address=Key.address_from_hex(actor_id)):
+            try:
+                UUID(utxo.output.value.decode())
+            except ValueError:
+                continue
+            picked.append(utxo.output.value.decode())
         return picked
 
     def delete(self, object_id):
@@ -146,27 +148,26 @@ class StaticObjectRepository:
                 return
 
     def check_remove(self):
-        for utxos in self.db_rep.find_utxos():
-            for out in utxos.transaction.outputs:
-                if out.value in [o.object_id.encode() for o in self.world] \
-                        and len(utxos.transaction.outputs) != 1:
-                    self.delete(out.value.decode())
-                    break
+        for utxo in self.db_rep.find_utxos():
+            out = utxo.output
+            if out.value in [o.object_id.encode() for o in self.world] \
+                    and not self.is_object_script(out.lock_script):
+                self.delete(out.value.decode())
 
     def check_new(self):
-        for utxos in self.db_rep.find_utxos():
-            for out in utxos.transaction.outputs:
-                if out.value in [o.object_id.encode() for o in self.world] \
-                        or len(utxos.transaction.outputs) != 1:
-                    continue
-                if out.value.count(b'-') == 4 and len(out.value) == 36:
-                    pos = self.get_object_position_from_script(out.lock_script)
-                    self.world.append(
-                        StaticObject(
-                            position=pos,
-                            object_id=out.value.decode()
-                        )
+        for utxo in self.db_rep.find_utxos():
+            out = utxo.output
+            if out.value in [o.object_id.encode() for o in self.world] \
+                    or not self.is_object_script(out.lock_script):
+                continue
+            if out.value.count(b'-') == 4 and len(out.value) == 36:
+                pos = self.get_object_position_from_script(out.lock_script)
+                self.world.append(
+                    StaticObject(
+                        position=pos,
+                        object_id=out.value.decode()
                     )
+                )
 
     def pick_object(self, actor_key: str) -> Transaction | None:
         actor_pos = self.actor_rep.get_position(actor_key.hexaddress)
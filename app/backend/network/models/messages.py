@@ -4,7 +4,7 @@ from hashlib import sha256
 from enum import Enum
 import struct
 
-from app.backend.network.models import Node, NetworkBlock, NetworkTransaction
+from app.backend.network.models import Node, NetworkBlock, NetworkTransaction, NetworkBlockHeader
 
 
 class Command(Enum):
@@ -14,6 +14,8 @@ class Command(Enum):
     blocks = 3
     transactions = 4
     error = 5
+    headers = 6
+    get_data = 7
 
 
 class Message(BaseModel):
@@ -81,21 +83,31 @@ class NodesStorePayload(Payload):
 
 
 class GetBlocksPayload(Payload):
+    """Request of blocks page
+
+    Without locator page is counted by offset from tip. With locator, blocks after
+    first locator hash found in chain of node are returned.
+    """
     offset: int = 0
     count: int = Field(le=500, default=500)
     only_headers: bool = False
+    locator: list[str] = Field(default_factory=list, max_length=100)
+    _HEADER_SIZE: int = struct.calcsize('>QH?')
 
     @model_serializer
     def encode(self) -> bytes:
-        return struct.pack('>QH?', self.offset, self.count, self.only_headers)
+        header = struct.pack('>QH?', self.offset, self.count, self.only_headers)
+        return header + b''.join([struct.pack('>64s', block_hash.encode()) for block_hash in self.locator])
 
     @model_validator(mode='before')
     @classmethod
     def decode(cls, data: bytes | dict):
         if isinstance(data, dict):
             return data
-        offset, count, only_headers = struct.unpack('>QH?', data)
-        return cls(offset=offset, count=count, only_headers=only_headers)
+        header_size = cls._HEADER_SIZE.default
+        offset, count, only_headers = struct.unpack('>QH?', data[:header_size])
+        locator = [data[i:i + 64].rstrip(b'\x00').decode() for i in range(header_size, len(data), 64)]
+        return cls(offset=offset, count=count, only_headers=only_headers, locator=locator)
 
 
 class BlocksPayload(Payload):
@@ -113,7 +125,7 @@ class BlocksPayload(Payload):
         blocks = []
         i = 0
         while i < len(data):
-            _, _, _, txs_size = struct.unpack('>dQ64sQ', data[i:i + NetworkBlock._HEADER_SIZE.default])
+            _, _, _, txs_size = struct.unpack('>qQ64sQ', data[i:i + NetworkBlock._HEADER_SIZE.default])
             block_size = NetworkBlock._HEADER_SIZE.default + txs_size
             blocks.append(NetworkBlock.decode(data[i:i + block_size]))
             i += block_size
@@ -149,3 +161,36 @@ class TransactionsPayload(Payload):
             i += tx_header * 2 + outputs_size + inputs_size
         return cls(transactions=txs)
 
+
+class HeadersPayload(Payload):
+    headers: list[NetworkBlockHeader]
+
+    @model_serializer
+    def encode(self) -> bytes:
+        return b''.join([header.encode() for header in self.headers])
+
+    @model_validator(mode='before')
+    @classmethod
+    def decode(cls, data: bytes | dict):
+        if isinstance(data, dict):
+            return data
+        size = NetworkBlockHeader._HEADER_SIZE.default
+        headers = [NetworkBlockHeader.decode(data[i:i + size]) for i in range(0, len(data), size)]
+        return cls(headers=headers)
+
+
+class GetDataPayload(Payload):
+    """Request of blocks by hashes"""
+    hashes: list[str] = Field(max_length=500)
+
+    @model_serializer
+    def encode(self) -> bytes:
+        return b''.join([struct.pack('>64s', block_hash.encode()) for block_hash in self.hashes])
+
+    @model_validator(mode='before')
+    @classmethod
+    def decode(cls, data: bytes | dict):
+        if isinstance(data, dict):
+            return data
+        hashes = [data[i:i + 64].rstrip(b'\x00').decode() for i in range(0, len(data), 64)]
+        return cls(hashes=hashes)
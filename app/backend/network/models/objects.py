@@ -1,9 +1,13 @@
 from pydantic import BaseModel, Field, AliasChoices
 from pydantic.networks import IPvAnyAddress
+from hashlib import sha256
 import struct
 import datetime as dt
 
 from app.backend.utils import asdict
+from app.backend.database.models import TXInput, TXOutput, Transaction, Block
+
+_EPOCH = dt.datetime(1970, 1, 1, tzinfo=dt.UTC)
 
 
 class NodeInfo(BaseModel):
@@ -29,98 +33,47 @@ class Node(BaseModel):
 
 
 class NetworkTXInput(BaseModel):
+    """Encoded with TXInput layout"""
     tx_id: str
     output_index: int
     unlock_script: bytes
     _HEADER_SIZE: int = struct.calcsize('>64sHQ')
 
-    @property
-    def ENCODED_SIZE(self) -> int:
-        return self.HEADER_SIZE + len(unlock_script)
-
     def encode(self) -> bytes:
-        return struct.pack(
-            f'>64sHQ{len(self.unlock_script)}s',
-            self.tx_id.encode(),
-            self.output_index,
-            len(self.unlock_script),
-            self.unlock_script
-        )
+        return TXInput(**self.model_dump()).pack()
 
     @classmethod
     def decode(cls, data: bytes):
-        tx_id, output_index, script_size = struct.unpack('>64sHQ', data[:cls._HEADER_SIZE.default])
-        return cls(
-            tx_id=tx_id.decode(),
-            output_index=output_index,
-            unlock_script=data[cls._HEADER_SIZE.default:]
-        )
+        return cls(**asdict(TXInput.unpack(data)[0]))
 
 
 class NetworkTXOutput(BaseModel):
+    """Encoded with TXOutput layout"""
     input_index: int
     value: bytes
     lock_script: bytes
     _HEADER_SIZE: int = struct.calcsize('>HQ')
 
     def encode(self) -> bytes:
-        return struct.pack(
-            f'>HQ{len(self.value)}sQ{len(self.lock_script)}s',
-            self.input_index,
-            len(self.value),
-            self.value,
-            len(self.lock_script),
-            self.lock_script
-        )
+        return TXOutput(**self.model_dump()).pack()
 
     @classmethod
     def decode(cls, data: bytes):
-        input_index, value_size = struct.unpack('>HQ', data[:cls._HEADER_SIZE.default])
-        value = data[cls._HEADER_SIZE.default:cls._HEADER_SIZE.default + value_size]
-        return cls(
-            input_index=input_index,
-            value=value,
-            lock_script=data[cls._HEADER_SIZE.default + value_size + 8:]
-        )
+        return cls(**asdict(TXOutput.unpack(data)[0]))
 
 
 class NetworkTransaction(BaseModel):
+    """Encoded with canonical Transaction layout, which is also hashed for its id"""
     outputs: list[NetworkTXOutput]
     inputs: list[NetworkTXInput]
     _HEADER_SIZE: int = struct.calcsize('>Q')
 
     def encode(self) -> bytes:
-        outputs_encoded = b''.join([out.encode() for out in self.outputs])
-        inputs_encoded = b''.join([inp.encode() for inp in self.inputs])
-        return struct.pack(
-            f'>Q{len(outputs_encoded)}sQ{len(inputs_encoded)}s',
-            len(outputs_encoded),
-            outputs_encoded,
-            len(inputs_encoded),
-            inputs_encoded
-        )
+        return Transaction.from_network_model(self).pack()
 
     @classmethod
     def decode(cls, data: bytes):
-        (outputs_size,) = struct.unpack('>Q', data[:cls._HEADER_SIZE.default])
-        outputs = []
-        inputs = []
-        i = cls._HEADER_SIZE.default
-        while i < outputs_size:
-            _, value_size = struct.unpack('>HQ', data[i:i + NetworkTXOutput._HEADER_SIZE.default])
-            script_size = data[i + NetworkTXOutput._HEADER_SIZE.default + value_size:i + NetworkTXOutput._HEADER_SIZE.default + value_size + 8]
-            (script_size,) = struct.unpack('>Q', script_size)
-            output_size = NetworkTXOutput._HEADER_SIZE.default + value_size + script_size + 8
-            outputs.append(NetworkTXOutput.decode(data[i:i + output_size]))
-            i += output_size
-        (inputs_size,) = struct.unpack('>Q', data[i:i + cls._HEADER_SIZE.default])
-        i += cls._HEADER_SIZE.default
-        while i - outputs_size < inputs_size:
-            _, _, script_size = struct.unpack('>64sHQ', data[i:i + NetworkTXInput._HEADER_SIZE.default])
-            input_size = NetworkTXInput._HEADER_SIZE.default + script_size
-            inputs.append(NetworkTXInput.decode(data[i:i + input_size]))
-            i += input_size
-        return cls(inputs=inputs, outputs=outputs)
+        return cls.from_db_model(Transaction.unpack(data)[0])
 
     @classmethod
     def from_db_model(cls, model):
@@ -129,47 +82,19 @@ class NetworkTransaction(BaseModel):
 
 
 class NetworkBlock(BaseModel):
+    """Encoded with Block layout, timestamp is exact to keep block hash"""
     timestamp: dt.datetime
     nounce: int
     prev_hash: str = Field(validation_alias=AliasChoices('previous_hash', 'prev_hash'))
     transactions: list[NetworkTransaction]
-    _HEADER_SIZE: int = struct.calcsize('>dQ64sQ')
+    _HEADER_SIZE: int = struct.calcsize('>qQ64sQ')
 
     def encode(self):
-        txs_encoded = b''.join([tx.encode() for tx in self.transactions])
-        return struct.pack(
-            f'>dQ64sQ{len(txs_encoded)}s',
-            self.timestamp.timestamp(),
-            self.nounce,
-            self.prev_hash.encode(),
-            len(txs_encoded),
-            txs_encoded
-        )
+        return Block.from_network_model(self).pack()
 
     @classmethod
     def decode(cls, data: bytes):
-        timestamp, nounce, prev_hash, txs_size = struct.unpack('>dQ64sQ', data[:88])
-        transactions = []
-        i = 88
-        tx_header = NetworkTransaction._HEADER_SIZE.default
-        while i - 88 < txs_size:
-            (outputs_size,) = struct.unpack('>Q', data[i:i + tx_header])
-            (inputs_size,) = struct.unpack(
-                '>Q',
-                data[
-                    i + tx_header + outputs_size
-                    :
-                    i + tx_header * 2 + outputs_size
-                ]
-            )
-            transactions.append(NetworkTransaction.decode(data[i:i + tx_header * 2 + outputs_size + inputs_size]))
-            i += tx_header * 2 + outputs_size + inputs_size
-        return cls(
-            timestamp=dt.datetime.fromtimestamp(timestamp, dt.UTC),
-            nounce=nounce,
-            prev_hash=prev_hash.decode(),
-            transactions=transactions
-        )
+        return cls.from_db_model(Block.unpack(data)[0])
 
     @classmethod
     def from_db_model(cls, model):
@@ -182,6 +107,42 @@ class NetworkBlock(BaseModel):
         return cls(**state)
 
 
+class NetworkBlockHeader(BaseModel):
+    """Encoded as Block.header, which is hashed for block hash"""
+    prev_hash: str
+    merkle_root: bytes
+    timestamp: dt.datetime
+    nounce: int
+    _HEADER_SIZE: int = struct.calcsize('>64s32sqQ')
+
+    @property
+    def hash(self) -> str:
+        return sha256(self.encode()).hexdigest()
+
+    def encode(self) -> bytes:
+        return struct.pack(
+            '>64s32sqQ',
+            self.prev_hash.encode(),
+            self.merkle_root,
+            (self.timestamp - _EPOCH) // dt.timedelta(microseconds=1),
+            self.nounce
+        )
+
+    @classmethod
+    def decode(cls, data: bytes):
+        prev_hash, merkle_root, timestamp, nounce = struct.unpack('>64s32sqQ', data)
+        return cls(
+            prev_hash=prev_hash.rstrip(b'\x00').decode(),
+            merkle_root=merkle_root,
+            timestamp=_EPOCH + dt.timedelta(microseconds=timestamp),
+            nounce=nounce
+        )
+
+    @classmethod
+    def from_db_model(cls, model):
+        return cls.decode(model.header)
+
+
 if __name__ == '__main__':
     inputs = [
         NetworkTXInput(output_index=0, tx_id='a' * 64, unlock_script=b'a'),
@@ -202,7 +163,7 @@ if __name__ == '__main__':
     blocks = []
     i = 0
     while i < len(encoded):
-        _, _, _, txs_size = struct.unpack('>dQ64sQ', encoded[i:i + NetworkBlock._HEADER_SIZE.default])
+        _, _, _, txs_size = struct.unpack('>qQ64sQ', encoded[i:i + NetworkBlock._HEADER_SIZE.default])
         block_size = NetworkBlock._HEADER_SIZE.default + txs_size
         blocks.append(NetworkBlock.decode(encoded[i:i + block_size]))
         i += block_size
@@ -1,7 +1,17 @@
 from app.backend.network.models import Message, Command
 from app.backend.network.models import GetBlocksPayload, BlocksPayload
 from app.backend.network.models import TransactionsPayload
-from app.backend.network.models import NetworkBlock, NetworkTransaction
+from app.backend.network.models import NetworkBlock, NetworkTransaction, NetworkBlockHeader
+from app.backend.network.models import GetDataPayload, Node
+from app.backend.database.models import Block
+from app.backend.database.miner import BLOCK_HASH_PREFIX
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import os
+
+SYNC_RANGE_SIZE = int(os.getenv('SYNC_RANGE_SIZE', '100'))
+SYNC_REQUEST_TIMEOUT = float(os.getenv('SYNC_REQUEST_TIMEOUT', '10'))
+SYNC_RETRIES = int(os.getenv('SYNC_RETRIES', '3'))
+SYNC_MAX_HEADERS = int(os.getenv('SYNC_MAX_HEADERS', '100000'))
 
 
 class NetworkRepository:
@@ -20,13 +30,151 @@ class NetworkRepository:
             self.node_service.store_node(node)
         return response
 
-    def request_blocks(self) -> list[list[NetworkBlock]]:
-        msg = self.node_service.make_message(
-            command=Command.get_blocks,
-            payload=GetBlocksPayload().encode()
-        )
-        responses = self.node_service.do_broadcast_request(msg)
-        return [resp.blocks for resp in responses]
+    @staticmethod
+    def _get_hash(model: NetworkBlock | NetworkBlockHeader) -> str:
+        if isinstance(model, NetworkBlockHeader):
+            return model.hash
+        return Block.from_network_model(model).hash
+
+    def _request_chain(self, node, locator: list[str], only_headers: bool = False) -> list[NetworkBlock | NetworkBlockHeader]:
+        """Request chain of node after fork point with locator by pages, return it from tip to fork point
+
+        Next page is requested with locator of last received block. Paging stops at page,
+        which is not linked to previous one, and after SYNC_MAX_HEADERS blocks.
+        Empty list is returned if node fails.
+        """
+        chain = []
+        while len(chain) < SYNC_MAX_HEADERS:
+            payload = GetBlocksPayload(locator=locator, only_headers=only_headers)
+            msg = self.node_service.make_message(command=Command.get_blocks, payload=payload.encode())
+            try:
+                response = self.node_service.do_direct_request(msg, (str(node.ip), node.port))
+                page = getattr(response, 'headers' if only_headers else 'blocks', None)
+                hashes = [self._get_hash(model) for model in page or []]
+            except Exception as e:
+                print("Failed to request chain from", node, e)
+                return []
+            if not page:
+                break
+            # Linked page after last received block always advances
+            if any(page[i].prev_hash != hashes[i + 1] for i in range(len(page) - 1)):
+                break
+            if chain and page[-1].prev_hash != locator[0]:
+                break
+            chain = page[-(SYNC_MAX_HEADERS - len(chain)):] + chain  # Oldest blocks, which are linked to chain
+            if len(page) < payload.count:
+                break
+            locator = [hashes[0]]
+        return chain
+
+    def _get_nodes(self) -> list[Node]:
+        return [node for node in self.node_service.nodes_store.get() if node != self.node_service.sender]
+
+    def request_headers(self, locator: list[str]) -> list[tuple[Node, list[NetworkBlockHeader]]]:
+        """Return nodes with their headers chains after fork point, from tip to fork point"""
+        chains = [(node, self._request_chain(node, locator, only_headers=True)) for node in self._get_nodes()]
+        return [(node, chain) for node, chain in chains if chain]
+
+    @staticmethod
+    def validate_headers(headers: list[NetworkBlockHeader], locator: list[str]) -> bool:
+        """Check that headers chain from tip to fork point is linked, mined and forks from locator hash"""
+        if not headers or headers[-1].prev_hash not in locator:
+            return False
+        hashes = [header.hash for header in headers]
+        for i, header in enumerate(headers):
+            if not hashes[i].startswith(BLOCK_HASH_PREFIX):
+                return False
+            if i + 1 < len(headers) and header.prev_hash != hashes[i + 1]:
+                return False
+        return True
+
+    def _request_range(self, node: Node, hashes: list[str]) -> list[NetworkBlock] | None:
+        """Return blocks of hashes in the same order or None if node failed to send them"""
+        msg = self.node_service.make_message(command=Command.get_data, payload=GetDataPayload(hashes=hashes).encode())
+        try:
+            response = self.node_service.do_direct_request(msg, (str(node.ip), node.port))
+        except Exception as e:
+            print("Failed to request blocks from", node, e)
+            return
+        blocks = getattr(response, 'blocks', None)
+        if blocks is None or [self._get_hash(block) for block in blocks] != hashes:
+            return
+        return blocks
+
+    def download_blocks(self, hashes: list[str], nodes: list[tuple[Node, set[str]]]) -> list[NetworkBlock] | None:
+        """Download blocks in ranges from nodes in parallel
+
+        nodes: node and hashes of its chain, range is requested only from nodes having it.
+        Range is requested again from other node if node fails, or in addition if it is slow.
+        Return None if some range could not be downloaded.
+        """
+        ranges = {start: hashes[start:start + SYNC_RANGE_SIZE] for start in range(0, len(hashes), SYNC_RANGE_SIZE)}
+        results: dict[int, list[NetworkBlock]] = {}
+        tried = {start: [] for start in ranges}  # Nodes range was requested from
+        running = {}  # Future -> range start
+        next_node = 0
+        executor = ThreadPoolExecutor(max_workers=max(len(nodes), 1) * 2)
+
+        def assign(start) -> bool:
+            nonlocal next_node
+            having = [node for node, node_hashes in nodes if ranges[start][-1] in node_hashes]
+            if not having or len(tried[start]) >= SYNC_RETRIES:
+                return False
+            not_tried = [node for node in having if node not in tried[start]]
+            candidates = not_tried or having
+            node = candidates[next_node % len(candidates)]
+            next_node += 1
+            tried[start].append(node)
+            running[executor.submit(self._request_range, node, ranges[start])] = start
+            return True
+
+        try:
+            for start in ranges:
+                if not assign(start):
+                    return
+            while len(results) < len(ranges):
+                if not running:
+                    return
+                done, _ = wait(running, timeout=SYNC_REQUEST_TIMEOUT, return_when=FIRST_COMPLETED)
+                if not done:  # Slow nodes, ask other nodes too
+                    for start in set(running.values()):
+                        assign(start)
+                    continue
+                for future in done:
+                    start = running.pop(future)
+                    if start in results:
+                        continue
+                    blocks = future.result()
+                    if blocks is not None:
+                        results[start] = blocks
+                    elif not assign(start) and start not in running.values():
+                        print("Failed to download blocks from", start)
+                        return
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        return [block for start in sorted(results) for block in results[start]]
+
+    def download_chain(self, locator: dict[str, int]) -> list[NetworkBlock]:
+        """Headers-first download of best chain from nodes, from tip to fork point
+
+        locator: hashes of our chain with their heights, from tip to genesis.
+        Headers after fork point are requested from every node, valid chain reaching
+        the greatest height is selected, then its blocks are downloaded in parallel
+        ranges from nodes having them. Empty list is returned if our chain is the best.
+        """
+        hashes = list(locator)
+        chains = [(node, headers) for node, headers in self.request_headers(hashes) if self.validate_headers(headers, hashes)]
+        if not chains:
+            return []
+        best = max((headers for _, headers in chains), key=lambda headers: locator[headers[-1].prev_hash] + len(headers))
+        if locator[best[-1].prev_hash] + len(best) <= max(locator.values()):
+            return []
+        hashes = [header.hash for header in best][::-1]
+        nodes = [(node, {header.hash for header in headers}) for node, headers in chains]
+        blocks = self.download_blocks(hashes, nodes)
+        if blocks is None:
+            return []
+        return blocks[::-1]
 
     def relay_block(self, block: NetworkBlock) -> list[Message]:
         msg = self.node_service.make_message(
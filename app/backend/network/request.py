@@ -3,6 +3,7 @@ from app.backend.network.models import NodesStorePayload, BlocksPayload
 from app.backend.network.models import GetBlocksPayload
 from app.backend.network.models import NetworkBlock, NetworkTransaction, NetworkTXInput, NetworkTXOutput
 from app.backend.network.models import TransactionsPayload
+from app.backend.network.models import HeadersPayload, GetDataPayload, NetworkBlockHeader
 
 from app.backend.utils import asdict
 from app.backend.database.models import ValidateError, Block, Transaction
@@ -19,40 +20,42 @@ class RequestWorker:
         self.db_rep = database_repository
         self.nodes_store = nodes_store
 
-    def get_blocks(self, request_payload: bytes):
+    def get_blocks(self, request_payload: bytes) -> list[NetworkBlock | NetworkBlockHeader]:
+        """Return page of chain from tip to genesis
+
+        Page starts after fork point found by locator, or is counted by offset from tip.
+        """
         request_payload = GetBlocksPayload.decode(request_payload)
-        k = 0
-        blocks = []
-        iterator = self.db_rep.iterate_blocks()
-        while k < request_payload.count:
-            try:
-                block = next(iterator)
-            except StopIteration:
-                break
-            blocks.append(NetworkBlock.from_db_model(block))
-            if blocks[-1].prev_hash == '':
-                break
-        return blocks
+        if request_payload.locator:
+            start = self.db_rep.find_fork_height(request_payload.locator) + 1
+            stop = start + request_payload.count
+        else:
+            stop = self.db_rep.get_chain_height() - request_payload.offset + 1
+            start = stop - request_payload.count
+        blocks = self.db_rep.iterate_blocks_by_height(start, stop)
+        network_model = NetworkBlockHeader if request_payload.only_headers else NetworkBlock
+        return [network_model.from_db_model(block) for block in blocks][::-1]
+
+    def get_data(self, request_payload: bytes) -> list[NetworkBlock]:
+        """Return stored blocks of requested hashes"""
+        request_payload = GetDataPayload.decode(request_payload)
+        blocks = [self.db_rep.get_block(block_hash) for block_hash in request_payload.hashes]
+        return [NetworkBlock.from_db_model(block) for block in blocks if block is not None]
 
     def add_blocks(self, request_payload: bytes) -> bool:
         request_payload = BlocksPayload.decode(request_payload)
         for block in request_payload.blocks:
             block = Block.from_network_model(block)
             try:
-                self.db_rep.store_block(block)
+                self.db_rep.process_block(block)
             except ValidateError:
                 return False
         return True
 
     def add_transactions(self, request_payload: bytes) -> bool:
         request_payload = TransactionsPayload.decode(request_payload)
-        for tx in request_payload.transactions:
-            tx = Transaction.from_network_model(tx)
-            try:
-                self.db_rep.store_transaction(tx)
-            except ValidateError:
-                return False
-        return True
+        txs = [Transaction.from_network_model(tx) for tx in request_payload.transactions]
+        return all(self.db_rep.store_transactions(txs))
 
     def handle(self, data: bytes) -> Message:
         msg = Message.from_bytes(data)
@@ -68,6 +71,11 @@ class RequestWorker:
                     payload=payload.encode()
                 )
             case Command.get_blocks:
+                if GetBlocksPayload.decode(msg.payload).only_headers:
+                    return Message(
+                        command=Command.headers,
+                        payload=HeadersPayload(headers=self.get_blocks(msg.payload)).encode()
+                    )
                 payload = BlocksPayload(
                     blocks=self.get_blocks(msg.payload)
                 )
@@ -75,6 +83,11 @@ class RequestWorker:
                     command=Command.blocks,
                     payload=payload.encode()
                 )
+            case Command.get_data:
+                return Message(
+                    command=Command.blocks,
+                    payload=BlocksPayload(blocks=self.get_data(msg.payload)).encode()
+                )
             case Command.blocks:
                 status = self.add_blocks(msg.payload)
                 if not status:
@@ -1,5 +1,5 @@
 from app.backend.network.models import Message, Command
-from app.backend.network.models import BlocksPayload, NodesStorePayload
+from app.backend.network.models import BlocksPayload, NodesStorePayload, HeadersPayload
 from app.backend.network.models import Payload
 
 
@@ -11,6 +11,8 @@ class ResponseWorker:
                 return NodesStorePayload.decode(msg.payload)
             case Command.blocks:
                 return BlocksPayload.decode(msg.payload)
+            case Command.headers:
+                return HeadersPayload.decode(msg.payload)
             case Command.error:
                 if msg.payload == b'OK':
                     return
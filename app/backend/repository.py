@@ -69,19 +69,19 @@ class BackendRepository:
     def init(self, seeder_address: tuple):
         self.net_rep.init()
         self.net_rep.update_nodes_store(seeder_address)
-        blocks = self.net_rep.request_blocks()
-        if any(blocks):
-            blocks = max(blocks, key=len)
-            for i in range(len(blocks) - 1, -1, -1):
-                blocks[i] = Block.from_network_model(blocks[i])
-            genesis_block = blocks[-1]
-            assert genesis_block.previous_hash == ''
+        blocks = self.net_rep.download_chain(self.db_rep.get_locator())
+        if blocks:
+            blocks = [Block.from_network_model(block) for block in blocks]
             self.db_rep.append_chain(blocks[::-1])
+        genesis_block = self.db_rep.get_block_by_height(0)
+        if genesis_block is not None:
             self.static_rep.init(genesis_block.hash)
         else:
             while len(blocks := list(self.db_rep.iterate_blocks())) == 0:
                 pass
                 block = self.db_rep.generate_block()
+                if block is None:
+                    continue
                 print(block)
                 print("GENERATED", len(block.transactions), 'transactrions')
                 self.db_rep.store_block(block)
@@ -123,9 +123,12 @@ class BackendRepository:
                 for tx in object_txs:
                     self.db_rep.store_transaction(tx)
                 block = self.db_rep.generate_block()
-                self.db_rep.store_block(block)
+                if block is not None:
+                    self.db_rep.store_block(block)
             elif cmd == 'gen':
                 block = self.db_rep.generate_block()
+                if block is None:
+                    continue
                 print(block)
                 print("GENERATED", len(block.transactions), 'transactrions')
                 self.db_rep.store_block(block)
@@ -135,6 +138,8 @@ class BackendRepository:
                 print(self.static_rep.get_actor_picked(self.myactor.id))
             elif cmd == 'txs':
                 print(*map(str, self.db_rep.find_utxos()), sep='\n')
+            elif cmd == 'limits':
+                print(self.db_rep.get_script_rejections())
             elif cmd == 'abc':
                 self.db_rep.tx_service.db_service.abc()
             event = None
@@ -3,6 +3,13 @@ from app.backend.database.database import DatabaseService
 from app.backend.database.transaction import TransactionService
 from app.backend.database.repository import DatabaseRepository
 from app.backend.database.key import KeyService
+from app.backend.database.blockfile import BlockFileService
+from app.backend.database.utxo import UTXOSet
+from app.backend.database.miner import MinerService
+from app.backend.database.orphans import OrphanPool
+from app.backend.database.mempool import Mempool
+from app.backend.database.template import BlockTemplate
+from app.backend.database.validation import ValidationService
 
 from app.backend.engine.actor import ActorRepository, MoveDirections
 from app.backend.engine.static import StaticObjectRepository
@@ -38,12 +45,16 @@ LOCAL_MODE = int(os.getenv('LOCAL_MODE', '0'))
 NODE_ONLY = int(os.getenv('NODE_ONLY', '0'))
 ADDRESS = os.getenv('ADDRESS', 'key')
 
+validation_service = ValidationService()  # Forks its workers, before database starts its threads
+miner_service = MinerService()  # The same for miner workers
 db_service = DatabaseService()
 key_service = KeyService()
 
-trans_rep = TransactionService(db_service)
-block_rep = BlockService(db_service)
-db_rep = DatabaseRepository(block_rep, trans_rep, key_service)
+block_rep = BlockService(db_service, BlockFileService(), miner_service)
+utxo_set = UTXOSet(db_service)
+mempool = Mempool(db_service, utxo_set)
+trans_rep = TransactionService(db_service, block_rep, utxo_set, mempool, validation_service)
+db_rep = DatabaseRepository(block_rep, trans_rep, key_service, OrphanPool(), BlockTemplate(block_rep, mempool))
 
 actor_rep = ActorRepository(db_rep)
 static_rep = StaticObjectRepository(actor_rep, db_rep)
@@ -1,32 +1,328 @@
 from app.backend.database.block import BlockService
-from app.backend.database.database import DatabaseService
+from app.backend.database.database import DatabaseService, make_storage_backend
 from app.backend.database.transaction import TransactionService
 from app.backend.database.repository import DatabaseRepository
+from app.backend.database.key import KeyService
+from app.backend.database.blockfile import BlockFileService
+from app.backend.database.miner import MinerService
+from app.backend.database.utxo import UTXOSet
+from app.backend.database.orphans import OrphanPool
+from app.backend.database.mempool import Mempool
+from app.backend.database.template import BlockTemplate
+from app.backend.database.validation import ValidationService
+from app.backend.database import miner
+from app.backend.database.models import Block, TXInput, TXOutput, ValidateError, merkle_root
 
 from app.backend.engine.actor import ActorRepository
 from app.backend.engine.actor import MoveDirections
 
-from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
-from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey
+from hashlib import sha256
+import threading
+import pickle
+import time
+import pytest
 
 
-private_key = Ed25519PrivateKey.generate()
+def make_repository(name: str = 'db', backend: str = 'log') -> DatabaseRepository:
+    db_service = DatabaseService(make_storage_backend(backend, name))
+    block_service = BlockService(db_service, BlockFileService(name + '_blocks'), MinerService(1))
+    utxo_set = UTXOSet(db_service)
+    mempool = Mempool(db_service, utxo_set)
+    tx_service = TransactionService(db_service, block_service, utxo_set, mempool, ValidationService(1))
+    return DatabaseRepository(block_service, tx_service, KeyService(), OrphanPool(), BlockTemplate(block_service, mempool))
 
-db_service = DatabaseService()
 
-tx_service = TransactionService(db_service, private_key)
-block_rep = BlockService(db_service)
-db_rep = DatabaseRepository(block_rep, tx_service)
-actor_rep = ActorRepository(database_repository=db_rep)
+@pytest.fixture
+def db_rep(tmp_path, monkeypatch) -> DatabaseRepository:
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'keys').mkdir()
+    return make_repository()
 
 
-if __name__ == '__main__':
-    actor = actor_rep.make()
-    tx = actor_rep.move(actor.id, MoveDirections.RIGHT)
-    tx = actor_rep.move(actor.id, MoveDirections.RIGHT)
-    tx = actor_rep.move(actor.id, MoveDirections.RIGHT)
+def test_actor_move(db_rep):
+    actor_rep = ActorRepository(db_rep)
+    key = db_rep.generate_key('password')
+    db_rep.store_transaction(actor_rep.make_move(key, MoveDirections.RIGHT))
+    db_rep.store_block(db_rep.generate_block())
+    position = actor_rep.get_position(key.hexaddress)
+    db_rep.store_transaction(actor_rep.make_move(key, MoveDirections.RIGHT))
+    db_rep.store_block(db_rep.generate_block())
+    assert actor_rep.get_position(key.hexaddress) == (position[0] + 1, position[1])
+
+
+def test_transaction_location(db_rep):
+    actor_rep = ActorRepository(db_rep)
+    key = db_rep.generate_key('password')
+    tx = actor_rep.make_move(key, MoveDirections.RIGHT)
+    db_rep.store_transaction(tx)
+    block = db_rep.generate_block()
+    db_rep.store_block(block)
+    location = db_rep.block_service.get_transaction_location(tx.id)
+    assert location.block_hash == block.hash
+    assert db_rep.block_service.get_transaction(tx.id) == tx
+
+
+def test_block_cache_rolled_back(db_rep):
+    block = db_rep.generate_block()
+    with pytest.raises(ValueError):
+        with db_rep.block_service.db_service.batch():
+            db_rep.block_service.store(block)
+            assert db_rep.get_block(block.hash) is not None
+            raise ValueError
+    assert db_rep.get_block(block.hash) is None
+    db_rep.store_block(block)
+    assert db_rep.get_block(block.hash).hash == block.hash
+
+
+def _utxo_ids(db_rep) -> list[str]:
+    return sorted(utxo.id for utxo in db_rep.find_utxos())
+
+
+def test_disconnect_block_reverts_utxos(db_rep):
+    actor_rep = ActorRepository(db_rep)
+    key = db_rep.generate_key('password')
+    db_rep.store_transaction(actor_rep.make_move(key, MoveDirections.RIGHT))
+    db_rep.store_block(db_rep.generate_block())
+    before = _utxo_ids(db_rep)
+    tx = actor_rep.make_move(key, MoveDirections.UP)
+    db_rep.store_transaction(tx)
+    block = db_rep.generate_block()
+    db_rep.store_block(block)
+    assert db_rep.block_service.get_undo(block.hash) is not None
+    assert db_rep.block_service.db_service.find('BlockUndo') == []  # Undo record is kept in block files
+
+    assert db_rep.disconnect_block().hash == block.hash
+    assert db_rep.block_service.get_undo(block.hash) is None
+    assert [t.id for t in db_rep.tx_service.mempool.select()] == [tx.id]
+    db_rep.tx_service.pop_all()
+    assert _utxo_ids(db_rep) == before
+
+
+def test_block_with_duplicate_transactions_rejected(db_rep):
+    actor_rep = ActorRepository(db_rep)
+    key = db_rep.generate_key('password')
+    db_rep.store_transaction(actor_rep.make_move(key, MoveDirections.RIGHT))
+    db_rep.store_transaction(actor_rep.make_move(key, MoveDirections.UP))
+    db_rep.store_transaction(actor_rep.make_move(key, MoveDirections.LEFT))
     block = db_rep.generate_block()
-    db_rep.store_block(block, validate_transactions=False)
-    print(actor_rep.get_position(actor.id))
+    duplicated = Block(
+        transactions=block.transactions + block.transactions[-1:],
+        previous_hash=block.previous_hash,
+        timestamp=block.timestamp,
+        nounce=block.nounce
+    )
+    assert duplicated.hash == block.hash
+
+    with pytest.raises(ValidateError):
+        db_rep.store_block(duplicated)
+    assert db_rep.get_block(block.hash) is None
+    db_rep.store_block(block)
+    assert db_rep.get_block(block.hash).transactions == block.transactions
+
+
+def test_duplicated_orphan_does_not_replace_valid_one(db_rep):
+    actor_rep = ActorRepository(db_rep)
+    key = db_rep.generate_key('password')
+    db_rep.store_transaction(actor_rep.make_move(key, MoveDirections.RIGHT))
+    db_rep.store_transaction(actor_rep.make_move(key, MoveDirections.UP))
+    db_rep.store_transaction(actor_rep.make_move(key, MoveDirections.LEFT))
+    parent = db_rep.make_block([], db_rep.block_service.get_tip_hash())
+    block = db_rep.make_block(db_rep.tx_service.mempool.select(), parent.hash)
+    duplicated = Block(
+        transactions=block.transactions + block.transactions[-1:],
+        previous_hash=block.previous_hash,
+        timestamp=block.timestamp,
+        nounce=block.nounce
+    )
+    assert duplicated.hash == block.hash
+
+    with pytest.raises(ValidateError):
+        db_rep.process_block(duplicated)
+    assert block.hash not in db_rep.orphan_pool
+    assert db_rep.process_block(block) is None
+    db_rep.process_block(parent)
+    assert db_rep.block_service.get_tip_hash() == block.hash
+    assert db_rep.get_block(block.hash).transactions == block.transactions
+
+
+def test_failed_reorganization_rolled_back(db_rep, monkeypatch):
+    genesis = db_rep.generate_block()
+    db_rep.store_block(genesis)
+    tip = db_rep.make_block([], genesis.hash)
+    db_rep.store_block(tip)
+    side = db_rep.make_block([], genesis.hash)
+    db_rep.store_block(side)
+    invalid_tx = db_rep.make_transaction(
+        [TXInput(tx_id=sha256(b'unknown').hexdigest(), output_index=0, unlock_script=b'')],
+        [TXOutput(input_index=0, lock_script=b'\x05', value=b'object')]
+    )
+    invalid = db_rep.make_block([invalid_tx], side.hash)
+
+    with pytest.raises(ValidateError):
+        db_rep.store_block(invalid)
+    tree = db_rep.block_service.tree
+    assert db_rep.block_service.get_tip_hash() == tip.hash
+    assert db_rep.get_block(invalid.hash) is None
+    assert invalid.hash not in tree
+    assert tree.get(side.hash).height == 1 and tree.get(tip.hash).height == 1
+
+    reorganizations = []
+    monkeypatch.setattr(db_rep, '_reorganize', reorganizations.append)
+    with pytest.raises(ValidateError):
+        db_rep.process_block(invalid)
+    assert reorganizations == []
+
+
+def test_reorganization_to_longer_branch(db_rep):
+    actor_rep = ActorRepository(db_rep)
+    key = db_rep.generate_key('password')
+    db_rep.store_transaction(actor_rep.make_move(key, MoveDirections.RIGHT))
+    genesis = db_rep.generate_block()
+    db_rep.store_block(genesis)
+    side_tx = actor_rep.make_move(key, MoveDirections.UP)
+    tip_tx = actor_rep.make_move(key, MoveDirections.DOWN)
+    db_rep.store_transaction(tip_tx)
+    tip = db_rep.generate_block()
+    db_rep.store_block(tip)
+    assert {inp.tx_id for inp in side_tx.inputs} & {inp.tx_id for inp in tip_tx.inputs}
+
+    first = db_rep.make_block([], genesis.hash)
+    db_rep.store_block(first)
+    assert db_rep.block_service.get_tip_hash() == tip.hash
+    second = db_rep.make_block([side_tx], first.hash)
+    db_rep.store_block(second)
+    assert db_rep.block_service.get_tip_hash() == second.hash
+    assert db_rep.get_block_by_height(1).hash == first.hash
+    assert db_rep.find_utxos(transaction_id=side_tx.id) != []
+    assert db_rep.find_utxos(transaction_id=tip_tx.id) == []
+    assert tip_tx.id not in db_rep.tx_service.mempool  # Spends the same outputs as side_tx
+
+
+def test_unmined_block_rejected(db_rep):
+    genesis = db_rep.generate_block()
+    db_rep.store_block(genesis)
+    unmined = Block(transactions=[], previous_hash=genesis.hash)
+    while unmined.hash.startswith(miner.BLOCK_HASH_PREFIX):
+        unmined.nounce += 1
+    orphan = Block(transactions=[], previous_hash=unmined.hash)
+    while orphan.hash.startswith(miner.BLOCK_HASH_PREFIX):
+        orphan.nounce += 1
+
+    with pytest.raises(ValidateError):
+        db_rep.store_block(unmined)
+    with pytest.raises(ValidateError):
+        db_rep.process_block(orphan)
+    assert unmined.hash not in db_rep.block_service.tree
+    assert orphan.hash not in db_rep.orphan_pool
+    assert db_rep.block_service.get_tip_hash() == genesis.hash
+
+
+class ReloadCounter:
+    def __init__(self):
+        self.reloads = 0
+
+    def tx_added(self, tx):
+        pass
+
+    def txs_removed(self, txs):
+        pass
+
+    def pool_reloaded(self):
+        self.reloads += 1
+
+
+def test_invalid_block_keeps_pool(db_rep):
+    actor_rep = ActorRepository(db_rep)
+    key = db_rep.generate_key('password')
+    db_rep.store_block(db_rep.generate_block())
+    tx = actor_rep.make_move(key, MoveDirections.RIGHT)
+    db_rep.store_transaction(tx)
+    counter = ReloadCounter()
+    db_rep.tx_service.mempool.add_listener(counter)
+    invalid_tx = db_rep.make_transaction(
+        [TXInput(tx_id=sha256(b'unknown').hexdigest(), output_index=0, unlock_script=b'')],
+        [TXOutput(input_index=0, lock_script=b'\x05', value=b'object')]
+    )
+
+    with pytest.raises(ValidateError):
+        db_rep.store_block(db_rep.make_block([tx, invalid_tx]))
+    assert counter.reloads == 0
+    assert tx.id in db_rep.tx_service.mempool
+    db_rep.store_block(db_rep.generate_block())
+    assert tx.id not in db_rep.tx_service.mempool
+
+
+def test_mempool_evicts_oldest_with_descendants(db_rep):
+    actor_rep = ActorRepository(db_rep)
+    first_key, second_key = db_rep.generate_key('password'), db_rep.generate_key('password')
+    mempool = db_rep.tx_service.mempool
+    mempool.max_count = 2
+    parent = actor_rep.make_move(first_key, MoveDirections.RIGHT)
+    db_rep.store_transaction(parent)
+    child = actor_rep.make_move(first_key, MoveDirections.UP)
+    db_rep.store_transaction(child)
+    assert parent.id in {inp.tx_id for inp in child.inputs}
+
+    other = actor_rep.make_move(second_key, MoveDirections.RIGHT)
+    db_rep.store_transaction(other)
+    assert [tx.id for tx in mempool.select()] == [other.id]
+    assert mempool.size == len(other.dump())
+
+
+def test_conflicting_transactions_pushed_concurrently(db_rep, monkeypatch):
+    actor_rep = ActorRepository(db_rep)
+    key = db_rep.generate_key('password')
+    db_rep.store_transaction(actor_rep.make_move(key, MoveDirections.RIGHT))
+    db_rep.store_block(db_rep.generate_block())
+    txs = [actor_rep.make_move(key, direction) for direction in (MoveDirections.UP, MoveDirections.DOWN)]
+    tx_service = db_rep.tx_service
+    validate = tx_service.validate
+
+    def slow_validate(tx):
+        valid = validate(tx)
+        time.sleep(0.1)  # Other thread validates conflicting transaction meanwhile
+        return valid
+
+    monkeypatch.setattr(tx_service, 'validate', slow_validate)
+    results = []
+
+    def push(tx):
+        try:
+            db_rep.store_transaction(tx)
+            results.append(True)
+        except ValidateError:
+            results.append(False)
+
+    threads = [threading.Thread(target=push, args=(tx,)) for tx in txs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(results) == [False, True]
+    assert len(tx_service.mempool) == 1
+
+
+def test_block_template_follows_pool(db_rep):
+    actor_rep = ActorRepository(db_rep)
+    key = db_rep.generate_key('password')
+    db_rep.store_block(db_rep.generate_block())
+    for direction in (MoveDirections.RIGHT, MoveDirections.UP, MoveDirections.LEFT):
+        db_rep.store_transaction(actor_rep.make_move(key, direction))
+    template = db_rep.block_template.get()
+    assert list(template.transactions) == db_rep.tx_service.mempool.select()
+    assert template.merkle_root == merkle_root([bytes.fromhex(tx.id) for tx in template.transactions])
+    assert template.previous_hash == db_rep.block_service.get_tip_hash()
+
+    db_rep.store_block(db_rep.block_service.mine(template))
+    assert db_rep.block_template.get().transactions == ()
 
 
+def test_chain_of_older_version_synced_again(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'keys').mkdir()
+    with open('db', 'wb') as f:
+        pickle.dump([('tip', {'tip': 'old block hash'}), ('utxos', {1: 'old outputs'})], f)
+    db_rep = make_repository()
+    assert db_rep.get_chain_height() == -1
+    assert db_rep.find_utxos() == []
+    assert db_rep.block_template.get().previous_hash == ''
@@ -1,32 +1,180 @@
-from app.backend.database.block import BlockRepository
-from app.backend.database.database import DatabaseService
-from app.backend.database.transaction import TransactionRepository
-from app.backend.engine.actor import ActorRepository, MoveDirections
-from app.backend.engine.static import StaticObjectRepository
-from app.backend.utils import asdict
+from app.backend.network import repository
 from app.backend.network.repository import NetworkRepository
-from app.backend.network.socket_service import SocketService
-from app.backend.network.request_factory import RequestFactory
-from app.backend.network.response_factory import ResponseFactory
-from app.backend.database.repository import DatabaseRepository
-from app.backend.repository import BackendRepository
+from app.backend.network.models import GetBlocksPayload, HeadersPayload, NetworkBlockHeader, Node
+from app.backend.network.models import Command, GetDataPayload, BlocksPayload, NetworkBlock
+from app.backend.database.models import Block
+from hashlib import sha256
+import datetime as dt
+import time
 
-import os
-import threading
 
-BIND_ADDRESS = os.getenv('BIND_ADDRESS', '127.0.0.1:8989').split(':')
-BIND_ADDRESS = (BIND_ADDRESS[0], int(BIND_ADDRESS[1]))
+def make_headers(count: int, prev_hash: str = '') -> list[NetworkBlockHeader]:
+    """Linked headers from oldest to newest"""
+    headers = []
+    for i in range(count):
+        header = NetworkBlockHeader(
+            prev_hash=prev_hash,
+            merkle_root=sha256(str(i).encode()).digest(),
+            timestamp=dt.datetime(2024, 1, 1, tzinfo=dt.UTC) + dt.timedelta(seconds=i),
+            nounce=i
+        )
+        headers.append(header)
+        prev_hash = header.hash
+    return headers
 
 
-db_service = DatabaseService()
-trans_rep = TransactionRepository(db_service)
-block_rep = BlockRepository(db_service, trans_rep)
-db_rep = DatabaseRepository(block_rep, trans_rep)
+class FakeNodeService:
+    """Serves pages of headers after first locator hash, from newest to oldest"""
 
-request_factory = RequestFactory()
-response_factory = ResponseFactory(db_rep)
-socket_service = SocketService(BIND_ADDRESS, response_factory, request_factory)
-net_rep = NetworkRepository(socket_service, request_factory, response_factory)
+    def __init__(self, headers: list[NetworkBlockHeader], fail: bool = False):
+        self.headers = headers
+        self.fail = fail
+        self.requests = 0
 
-net_rep.request_get_address_book()
+    def make_message(self, command, payload: bytes = b''):
+        return GetBlocksPayload.decode(payload)
 
+    def do_direct_request(self, payload: GetBlocksPayload, address):
+        self.requests += 1
+        if self.fail:
+            raise ConnectionError
+        hashes = [''] + [header.hash for header in self.headers]
+        start = hashes.index(payload.locator[0])
+        return HeadersPayload(headers=self.headers[start:start + payload.count][::-1])
+
+
+node = Node(ip='127.0.0.1', port=8989)
+
+
+def test_request_chain_by_pages():
+    headers = make_headers(1200)
+    net_rep = NetworkRepository(FakeNodeService(headers))
+    chain = net_rep._request_chain(node, [''], only_headers=True)
+    assert chain == headers[::-1]
+    assert net_rep.node_service.requests == 3
+
+
+def test_request_chain_limited(monkeypatch):
+    monkeypatch.setattr(repository, 'SYNC_MAX_HEADERS', 700)
+    headers = make_headers(1200)
+    chain = NetworkRepository(FakeNodeService(headers))._request_chain(node, [''], only_headers=True)
+    assert chain == headers[:700][::-1]
+
+
+def test_request_chain_stops_at_unlinked_page():
+    headers = make_headers(500) + make_headers(600, prev_hash=sha256(b'other').hexdigest())
+    chain = NetworkRepository(FakeNodeService(headers))._request_chain(node, [''], only_headers=True)
+    assert chain == headers[:500][::-1]
+
+
+def test_request_chain_of_failed_node():
+    node_service = FakeNodeService(make_headers(10), fail=True)
+    assert NetworkRepository(node_service)._request_chain(node, [''], only_headers=True) == []
+
+
+def make_blocks(count: int, prev_hash: str = '') -> list[NetworkBlock]:
+    """Linked blocks without transactions from oldest to newest"""
+    blocks = []
+    for i in range(count):
+        block = NetworkBlock(
+            prev_hash=prev_hash,
+            timestamp=dt.datetime(2024, 1, 1, tzinfo=dt.UTC) + dt.timedelta(seconds=i),
+            nounce=i,
+            transactions=[]
+        )
+        blocks.append(block)
+        prev_hash = Block.from_network_model(block).hash
+    return blocks
+
+
+def to_header(block: NetworkBlock) -> NetworkBlockHeader:
+    return NetworkBlockHeader(
+        prev_hash=block.prev_hash,
+        merkle_root=Block.from_network_model(block).merkle_root,
+        timestamp=block.timestamp,
+        nounce=block.nounce
+    )
+
+
+class FakeNetworkService:
+    """Nodes by port serving their chains of blocks
+
+    Failing node raises on every request, slow node answers after delay,
+    node with missing blocks announces whole chain, but sends only its first blocks.
+    """
+
+    def __init__(self, chains: dict[int, list[NetworkBlock]], fail=(), slow=(), missing: dict[int, int] = None):
+        self.chains = chains
+        self.fail = fail
+        self.slow = slow
+        self.missing = missing or {}
+        self.requests = {port: 0 for port in chains}
+        self.sender = None
+        self.nodes_store = self
+
+    def get(self) -> list[Node]:
+        return [Node(ip='127.0.0.1', port=port) for port in self.chains]
+
+    def make_message(self, command, payload: bytes = b''):
+        return command, payload
+
+    def do_direct_request(self, msg, address):
+        command, payload = msg
+        port = address[1]
+        self.requests[port] += 1
+        if port in self.fail:
+            raise ConnectionError
+        if port in self.slow:
+            time.sleep(0.5)
+        blocks = self.chains[port]
+        hashes = [Block.from_network_model(block).hash for block in blocks]
+        if command == Command.get_blocks:
+            payload = GetBlocksPayload.decode(payload)
+            start = ([''] + hashes).index(payload.locator[0])
+            return HeadersPayload(headers=[to_header(block) for block in blocks[start:start + payload.count][::-1]])
+        served = hashes[:self.missing.get(port, len(hashes))]
+        return BlocksPayload(blocks=[blocks[hashes.index(h)] for h in GetDataPayload.decode(payload).hashes if h in served])
+
+
+def _download(node_service: FakeNetworkService, blocks: list[NetworkBlock]) -> list[NetworkBlock] | None:
+    hashes = [Block.from_network_model(block).hash for block in blocks]
+    nodes = [(node, set(hashes)) for node in node_service.get()]
+    return NetworkRepository(node_service).download_blocks(hashes, nodes)
+
+
+def test_download_blocks_from_failing_node(monkeypatch):
+    monkeypatch.setattr(repository, 'SYNC_RANGE_SIZE', 10)
+    blocks = make_blocks(35)
+    node_service = FakeNetworkService({1: blocks, 2: blocks}, fail=(1,))
+    assert _download(node_service, blocks) == blocks
+    assert node_service.requests[1] > 0
+
+
+def test_download_blocks_from_slow_node(monkeypatch):
+    monkeypatch.setattr(repository, 'SYNC_RANGE_SIZE', 10)
+    monkeypatch.setattr(repository, 'SYNC_REQUEST_TIMEOUT', 0.05)
+    blocks = make_blocks(35)
+    node_service = FakeNetworkService({1: blocks, 2: blocks}, slow=(1,))
+    started = time.perf_counter()
+    assert _download(node_service, blocks) == blocks
+    assert time.perf_counter() - started < 0.5  # Ranges of slow node are downloaded from other node
+
+
+def test_download_blocks_with_missing_range(monkeypatch):
+    monkeypatch.setattr(repository, 'SYNC_RANGE_SIZE', 10)
+    blocks = make_blocks(35)
+    node_service = FakeNetworkService({1: blocks, 2: blocks}, missing={1: 20, 2: 20})
+    assert _download(node_service, blocks) is None
+    node_service = FakeNetworkService({1: blocks, 2: blocks}, missing={1: 20})
+    assert _download(node_service, blocks) == blocks
+
+
+def test_download_best_chain(monkeypatch):
+    monkeypatch.setattr(repository, 'BLOCK_HASH_PREFIX', '')
+    monkeypatch.setattr(repository, 'SYNC_RANGE_SIZE', 10)
+    blocks = make_blocks(30)
+    node_service = FakeNetworkService({1: blocks[:20], 2: blocks, 3: blocks}, fail=(3,))
+    locator = {Block.from_network_model(blocks[4]).hash: 4, '': -1}
+    assert NetworkRepository(node_service).download_chain(locator) == blocks[5:][::-1]
+    node_service = FakeNetworkService({1: blocks, 2: blocks}, missing={1: 10, 2: 10})
+    assert NetworkRepository(node_service).download_chain(locator) == []
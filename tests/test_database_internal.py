@@ -1,21 +1,29 @@
-from app.backend.database.models import MoveTransaction
-from app.backend.database.models import PickTransaction
-from app.backend.database.models import Block
-from app.backend.engine.models import Actor, StaticObject
-import random
-import struct
+from app.backend.database import storage, miner, orphans
+from app.backend.database.storage import LogStorage
+from app.backend.database.database import DatabaseService
+from app.backend.database.sqlite import SQLiteStorage
+from app.backend.database.models import Block, Transaction, TXInput, TXOutput, TransactionLocation, BlockIndex
+from app.backend.database.models import RECORD_VERSION, ValidateError, merkle_root
+from app.backend.database.utxo import UTXOSet
+from app.backend.database.script import ScriptService, ScriptBudget, ScriptBudgetError, Operation
+from app.backend.database.miner import MinerService
+from app.backend.database.orphans import OrphanPool
+from app.backend.database.template import MerkleTree
+from app.backend.database.validation import ValidationService, SignatureCache
+from app.backend.network.models.objects import NetworkTransaction, NetworkBlock, NetworkBlockHeader
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
 from hashlib import sha256
+import threading
+import pytest
+import pickle
 
-test_actor = Actor()
-move_trans_data = MoveTransaction.pack_data((132131230, 200000))
-move_trans = MoveTransaction(
-    data=move_trans_data,
-    actor=test_actor.id
+move_trans = Transaction(
+    inputs=[TXInput(tx_id=sha256(b'a').hexdigest(), output_index=0, unlock_script=b'\x00' * 10)],
+    outputs=[TXOutput(input_index=0, lock_script=b'\x05\x04', value=b'1;1')]
 )
-pick_trans_data = PickTransaction.pack_data(((12, 10), 1))
-pick_trans = PickTransaction(
-    data=pick_trans_data,
-    actor=test_actor.id
+pick_trans = Transaction(
+    inputs=[TXInput(tx_id=sha256(b'b').hexdigest(), output_index=1, unlock_script=b'')],
+    outputs=[TXOutput(input_index=0, lock_script=b'\x05\x04', value=b'object')]
 )
 
 block = Block(
@@ -24,25 +32,374 @@ block = Block(
 )
 
 
+def _location(i: int) -> TransactionLocation:
+    return TransactionLocation(id=sha256(str(i).encode()).hexdigest(), block_hash=block.hash, position=i)
+
+
 def test_move_transaction():
-    move_trans_dumped = move_trans.dump()
-    undumped_trans = MoveTransaction.undump(move_trans_dumped)
-    assert undumped_trans.data == move_trans.data
+    undumped_trans = Transaction.undump(move_trans.dump())
+    assert undumped_trans == move_trans
+    assert undumped_trans.id == move_trans.id
 
 
 def test_pick_transaction():
-    pick_trans_dumped = pick_trans.dump()
-    undumped_trans = PickTransaction.undump(pick_trans_dumped)
-    assert pick_trans.data == undumped_trans.data
+    undumped_trans = Transaction.undump(pick_trans.dump())
+    assert undumped_trans.outputs == pick_trans.outputs
 
 
 def test_block():
-    dumped_block = block.dump()
-    print(len(dumped_block))
-    undumped_block = Block.undump(dumped_block)
-    print(undumped_block)
+    undumped_block = Block.undump(block.dump())
+    assert undumped_block.hash == block.hash
+    assert undumped_block.transactions == block.transactions
+
+
+def test_log_replay(tmp_path):
+    filename = str(tmp_path / 'db')
+    log = LogStorage(filename)
+    for i in range(10):
+        log.save('transactionlocation', _location(i).id, _location(i))
+    log.delete('transactionlocation', _location(3).id)
+    log.close()
+
+    log = LogStorage(filename)
+    assert len(log.find('transactionlocation', {})) == 9
+    assert log.get('transactionlocation', _location(3).id) is None
+    assert log.get('transactionlocation', _location(4).id) == _location(4)
+    log.close()
+
+
+def test_log_compaction_with_concurrent_saves(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, 'DB_COMPACT_MIN_RECORDS', 50)
+    monkeypatch.setattr(storage, 'DB_COMPACT_RATIO', 2)
+    filename = str(tmp_path / 'db')
+    log = LogStorage(filename)
+    errors = []
+
+    def save_many(worker: int):
+        try:
+            for i in range(300):
+                location = _location(i % 20 + worker * 20)
+                log.save('transactionlocation', location.id, location)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=save_many, args=(worker,)) for worker in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    log.close()
+    assert not errors
+    assert log._log_records < 4 * 300  # Log was compacted
+
+    replayed = LogStorage(filename)
+    assert replayed.tables == log.tables
+    assert len(replayed.find('transactionlocation', {})) == 80
+    replayed.close()
+
+
+def test_batch_rollback(tmp_path):
+    db_service = DatabaseService(LogStorage(str(tmp_path / 'db')))
+    db_service.save(_location(0))
+    try:
+        with db_service.batch():
+            db_service.save(_location(1))
+            with db_service.batch():
+                db_service.delete('transactionlocation', _location(0).id)
+            raise ValueError
+    except ValueError:
+        pass
+    assert db_service.get('transactionlocation', _location(0).id) == _location(0)
+    assert db_service.get('transactionlocation', _location(1).id) is None
+
+
+def test_nested_batch_rolled_back_to_savepoint(tmp_path):
+    filename = str(tmp_path / 'db')
+    db_service = DatabaseService(LogStorage(filename))
+    with db_service.batch():
+        db_service.save(_location(0))
+        try:
+            with db_service.batch():
+                db_service.save(_location(1))
+                raise ValueError
+        except ValueError:
+            pass
+    db_service.backend.close()
+
+    db_service = DatabaseService(LogStorage(filename))
+    assert db_service.get('transactionlocation', _location(0).id) == _location(0)
+    assert db_service.get('transactionlocation', _location(1).id) is None
+
+
+def _block_index(i: int, previous_hash: str) -> BlockIndex:
+    return BlockIndex(id=sha256(str(i).encode()).hexdigest(), previous_hash=previous_hash, segment=0, offset=i, size=1, height=i)
+
+
+def test_find_by_index(tmp_path):
+    db_service = DatabaseService(LogStorage(str(tmp_path / 'db')))
+    parent = sha256(b'parent').hexdigest()
+    for i in range(5):
+        db_service.save(_block_index(i, parent if i % 2 else ''))
+    children = db_service.find('blockindex', previous_hash=parent)
+    assert sorted(index.offset for index in children) == [1, 3]
+    db_service.delete('blockindex', _block_index(1, parent).id)
+    assert [index.offset for index in db_service.find('blockindex', previous_hash=parent)] == [3]
+
+
+def test_old_database_moved_aside(tmp_path):
+    filename = str(tmp_path / 'db')
+    with open(filename, 'wb') as f:
+        pickle.dump([('transactionlocation', {_location(0).id: 'old row'})], f)  # Snapshot of older version
+    with open(filename, 'rb') as f:
+        old = f.read()
+
+    log = LogStorage(filename)
+    assert log.tables == {}
+    log.save('transactionlocation', _location(0).id, _location(0))
+    log.close()
+    with open(filename + '.bak', 'rb') as f:
+        assert f.read() == old
+    assert LogStorage(filename).get('transactionlocation', _location(0).id) == _location(0)
+
+
+def test_sqlite_round_trip(tmp_path):
+    filename = str(tmp_path / 'db.sqlite3')
+    db_service = DatabaseService(SQLiteStorage(filename))
+    parent = sha256(b'parent').hexdigest()
+    with db_service.batch():
+        for i in range(3):
+            db_service.save(_block_index(i, parent))
+    db_service.delete('blockindex', _block_index(0, parent).id)
+    db_service.backend.close()
+
+    db_service = DatabaseService(SQLiteStorage(filename))
+    assert db_service.get('blockindex', _block_index(1, parent).id) == _block_index(1, parent)
+    assert db_service.get('blockindex', _block_index(0, parent).id) is None
+    assert sorted(index.offset for index in db_service.find('blockindex', previous_hash=parent)) == [1, 2]
+    db_service.backend.close()
+
+
+def test_record_version():
+    dumped = _location(0).dump()
+    assert dumped[0] == RECORD_VERSION
+    assert TransactionLocation.undump(dumped) == _location(0)
+    with pytest.raises(ValueError):
+        TransactionLocation.undump(bytes([RECORD_VERSION + 1]) + dumped[1:])
+
+
+def test_utxo_set_apply_and_undo(tmp_path):
+    utxo_set = UTXOSet(DatabaseService(LogStorage(str(tmp_path / 'db'))))
+    utxo_set.add(pick_trans)
+    assert utxo_set.lookup(pick_trans.id, 0).output == pick_trans.outputs[0]
+
+    spender = Transaction(
+        inputs=[TXInput(tx_id=pick_trans.id, output_index=0, unlock_script=b'')],
+        outputs=[TXOutput(input_index=0, lock_script=b'\x05', value=b'object')]
+    )
+    spent, created = utxo_set.apply([spender])
+    assert utxo_set.lookup(pick_trans.id, 0) is None
+    assert utxo_set.lookup(spender.id, 0) is not None
+    utxo_set.undo(spent, created)
+    assert utxo_set.lookup(pick_trans.id, 0) is not None
+    assert utxo_set.lookup(spender.id, 0) is None
+
+    utxo_set.apply([spender])
+    with pytest.raises(ValidateError):
+        utxo_set.apply([spender])  # Input is already spent
+    assert utxo_set.lookup(spender.id, 0) is not None
+
+
+def test_utxos_by_address(tmp_path):
+    utxo_set = UTXOSet(DatabaseService(LogStorage(str(tmp_path / 'db'))))
+    address = sha256(b'public key').digest()
+    tx = Transaction(
+        inputs=[],
+        outputs=[
+            TXOutput(input_index=0, lock_script=ScriptService.make_address_lock_script(address), value=b'1;1'),
+            TXOutput(input_index=0, lock_script=b'\x05', value=b'object')
+        ]
+    )
+    utxo_set.add(tx)
+    assert [utxo.output_index for utxo in utxo_set.find(address=address)] == [0]
+    utxo_set.spend(tx.id, 0)
+    assert utxo_set.find(address=address) == []
+
+
+def test_mine_block():
+    mined = MinerService(1).mine(Block(transactions=[move_trans], previous_hash=block.hash))
+    assert mined.hash.startswith(miner.BLOCK_HASH_PREFIX)
+
+
+def test_mine_block_by_workers():
+    miner_service = MinerService(2, chunk_size=64)
+    assert miner_service._executor is not None  # Workers are forked before any mining
+    mined = miner_service.mine(Block(transactions=[move_trans], previous_hash=block.hash))
+    assert mined.hash.startswith(miner.BLOCK_HASH_PREFIX)
+    miner_service.close()
+
+
+def test_cancel_mining(monkeypatch):
+    monkeypatch.setattr(miner, 'BLOCK_HASH_PREFIX', 'f' * 64)  # Never found
+    miner_service = MinerService(1, chunk_size=1000)
+    timer = threading.Timer(0.2, miner_service.cancel, args=(block.hash,))
+    timer.start()
+    assert miner_service.mine(Block(transactions=[move_trans], previous_hash=block.hash)) is None
+    timer.join()
+
+
+def test_canonical_transaction_encoding():
+    assert move_trans.encode() == sha256(move_trans.dump()).digest()
+    assert move_trans.id == sha256(move_trans.encode()).hexdigest()
+    network_trans = NetworkTransaction.decode(move_trans.pack())
+    assert network_trans.encode() == move_trans.pack()
+    assert Transaction.from_network_model(network_trans).id == move_trans.id
+
+
+def test_block_hash_kept_over_network():
+    network_block = NetworkBlock.decode(block.pack())
+    assert Block.from_network_model(network_block).hash == block.hash
+    assert NetworkBlockHeader.from_db_model(block).hash == block.hash
+
+
+def _orphan(i: int, parent: str) -> Block:
+    return Block(transactions=[move_trans], previous_hash=parent, nounce=i)
+
+
+def test_orphan_pool_limits():
+    parent = sha256(b'parent').hexdigest()
+    pool = OrphanPool(max_count=3, max_size=10 ** 6, expiry=600)
+    orphans = [_orphan(i, parent) for i in range(5)]
+    for orphan in orphans:
+        assert pool.add(orphan)
+    assert not pool.add(orphans[-1])
+    assert len(pool) == 3 and orphans[0].hash not in pool
+    assert pool.size == 3 * len(orphans[0].dump())
+
+    assert pool.pop_children(parent) == orphans[2:]
+    assert len(pool) == 0 and pool.size == 0
+    assert not OrphanPool(max_size=len(orphans[0].dump()) - 1).add(orphans[0])
+
+
+def test_orphan_expired(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(orphans.time, 'monotonic', lambda: now[0])
+    pool = OrphanPool(expiry=10)
+    first, second = _orphan(0, block.hash), _orphan(1, block.hash)
+    pool.add(first)
+    now[0] += 5
+    pool.add(second)
+    now[0] += 6
+    assert pool.pop_children(block.hash) == [second]
+
+
+def test_incremental_merkle_root():
+    leaves = [sha256(str(i).encode()).digest() for i in range(17)]
+    tree = MerkleTree()
+    assert tree.root == merkle_root([])
+    for i, leaf in enumerate(leaves):
+        tree.append(leaf)
+        assert tree.root == merkle_root(leaves[:i + 1])
+
+
+def _push(data: bytes) -> bytes:
+    return Operation.push.value + len(data).to_bytes(8) + data
+
+
+def test_parallel_validation():
+    valid = [(_push(b'a'), _push(b'a') + Operation.check_equal.value, b'', [])] * 3
+    invalid = [(_push(b'a'), _push(b'b') + Operation.check_equal.value, b'', [])]
+    validation_service = ValidationService(2, min_parallel=1)
+    assert validation_service._executor is not None  # Workers are forked before any check
+    assert validation_service.check([valid, valid + invalid, [], invalid]) == [True, False, True, False]
+    validation_service.close()
+
+
+def test_signature_cache_lru():
+    cache = SignatureCache(max_size=2)
+    first, second, third = [(move_trans.id, i, b'') for i in range(3)]
+    cache.add([first, second])
+    assert first in cache  # Becomes most recently used
+    cache.add([third])
+    assert second not in cache and first in cache and third in cache
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_cached_checks_skipped():
+    invalid = (_push(b'a'), _push(b'b') + Operation.check_equal.value, b'', [])
+    valid = (_push(b'a'), _push(b'a') + Operation.check_equal.value, b'', [])
+    validation_service = ValidationService(1)
+    keys = [[(move_trans.id, 0, b'')], [(pick_trans.id, 0, b'')]]
+    assert validation_service.check([[valid], [invalid]], keys, store=True) == [True, False]
+    assert (move_trans.id, 0, b'') in validation_service.cache
+    assert (pick_trans.id, 0, b'') not in validation_service.cache
+    # Verified check is not run again
+    assert validation_service.check([[invalid]], keys[:1]) == [True]
+
+
+def _run_script(run, unlock_script: bytes, lock_script: bytes):
+    try:
+        return run(ScriptService(unlock_script, b'message', [b'alt'], lock_script))
+    except Exception as e:
+        return type(e)
+
+
+@pytest.mark.parametrize('unlock_script, lock_script', [
+    (_push(b'a'), _push(b'a') + Operation.check_equal.value),
+    (_push(b'a'), _push(b'b') + Operation.check_equal.value),
+    (_push(b'a'), Operation.duplicate_top.value + Operation.hash_top.value),
+    (Operation.push_alt.value, _push(b'alt') + Operation.check_equal.value),
+    (b'', Operation.check_equal.value),
+    (b'\xff', b''),
+    (b'', b'')
+])
+def test_compiled_script_equals_interpreted(unlock_script, lock_script):
+    compiled = _run_script(ScriptService.run_compiled, unlock_script, lock_script)
+    interpreted = _run_script(ScriptService.run_interpreted, unlock_script, lock_script)
+    assert compiled == interpreted
+
+
+_private_key = Ed25519PrivateKey.generate()
+_public_key = _private_key.public_key().public_bytes_raw()
+_address_lock_script = ScriptService.make_address_lock_script(sha256(_public_key).digest())
+
+
+@pytest.mark.parametrize('unlock_script, lock_script', [
+    (_push(_private_key.sign(b'message')) + _push(_public_key), _address_lock_script),
+    (_push(_private_key.sign(b'other')) + _push(_public_key), _address_lock_script),
+    (_push(_private_key.sign(b'message')) + _push(b'\x00' * 32), _address_lock_script),
+    (b'', _push(b'alt') + Operation.push_alt.value + Operation.check_equal.value),
+    (b'', _push(b'value') + Operation.push_alt.value + Operation.check_equal.value)
+])
+def test_script_template_equals_interpreted(unlock_script, lock_script):
+    assert ScriptService.match_template(lock_script)[0] is not None
+    assert _run_script(ScriptService._run_template, unlock_script, lock_script) == \
+        _run_script(ScriptService.run_interpreted, unlock_script, lock_script)
+
+
+@pytest.mark.parametrize('limit, unlock_script, lock_script', [
+    ('max_length', _push(b'a' * 60), b''),
+    ('max_ops', Operation.duplicate_top.value * 11, b''),
+    ('max_push_size', _push(b'a' * 21), b''),
+    ('max_stack_depth', _push(b'a') * 6, b'')
+])
+def test_script_budget_rejections(limit, unlock_script, lock_script):
+    budget = ScriptBudget(max_length=64, max_ops=10, max_push_size=20, max_stack_depth=5)
+    with pytest.raises(ScriptBudgetError):
+        budget.check_script(unlock_script, lock_script)
+    assert budget.rejected == {limit: 1}
+
+
+def test_transaction_script_budget():
+    check = (_push(b'a'), _push(b'a') + Operation.check_equal.value, b'', [])
+    budget = ScriptBudget(tx_max_ops=5)
+    budget.check_transaction([check])
+    with pytest.raises(ScriptBudgetError):
+        budget.check_transaction([check, check])
+    assert budget.rejected == {'tx_max_ops': 1}
 
 
-test_move_transaction()
-test_pick_transaction()
-test_block()
+def test_transaction_immutable():
+    with pytest.raises(AttributeError):
+        move_trans.outputs.append(pick_trans.outputs[0])
+    assert hash(Transaction.undump(move_trans.dump())) == hash(move_trans)
+    assert isinstance(Block.undump(block.dump()).transactions, tuple)